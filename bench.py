@@ -0,0 +1,149 @@
+"""Benchmarks for NetTransfer, run with: py bench.py <name>
+
+messages  round trip latency of the link/text/clipboard channel over loopback
+startup   import time, time-to-window and time-to-listening of the app
+"""
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+from file_transfer_app import MessageChannel, recv_json, serve_channel
+
+# Delivery target for messages to trusted peers
+MESSAGE_TARGET_MS = 10
+# Fresh interpreters started for the startup benchmark
+STARTUP_RUNS = 5
+
+# Runs in a fresh interpreter so nothing is imported or cached yet
+STARTUP_CHILD = """
+import json, time
+start = time.perf_counter()
+import tkinter as tk
+from file_transfer_app import FileTransferApp
+imported = time.perf_counter()
+try:
+    root = tk.Tk()
+except tk.TclError as e:
+    print(json.dumps({"import": imported - start, "error": str(e)}))
+    raise SystemExit
+app = FileTransferApp(root)
+root.update()
+window = time.perf_counter()
+app.server_ready.wait(10)
+listening = time.perf_counter()
+root.destroy()
+print(json.dumps({"import": imported - start, "window": window - start,
+                  "listening": listening - start if app.server_ready.is_set() else None}))
+"""
+
+
+def start_channel_server():
+    """Loopback channel server that acks everything, returns its port"""
+    server = socket.create_server(("127.0.0.1", 0))
+
+    def serve(client):
+        # The channel header is read by the app's connection handler before serve_channel
+        recv_json(client)
+        serve_channel(client, lambda messages: None)
+
+    def accept_loop():
+        while True:
+            client, _ = server.accept()
+            thread = threading.Thread(target=serve, args=(client,))
+            thread.daemon = True
+            thread.start()
+
+    thread = threading.Thread(target=accept_loop)
+    thread.daemon = True
+    thread.start()
+    return server.getsockname()[1]
+
+
+def bench_messages(count=1000, burst=1000):
+    port = start_channel_server()
+    latencies = []
+    acked = threading.Semaphore(0)
+
+    def on_ack(channel, message, latency, pending):
+        latencies.append(latency)
+        acked.release()
+
+    channel = MessageChannel("127.0.0.1", port, on_ack=on_ack)
+
+    # Warm up, the first message also opens the connection
+    channel.send("link", "https://example.com/")
+    acked.acquire()
+    latencies.clear()
+
+    # One message at a time, like links sent by hand
+    for i in range(count):
+        channel.send("link", f"https://example.com/{i}")
+        acked.acquire()
+
+    ms = sorted(latency * 1000 for latency in latencies)
+    p50 = statistics.median(ms)
+    p99 = ms[int(len(ms) * 0.99) - 1]
+    print(f"single messages: {count}  p50 {p50:.3f} ms  p99 {p99:.3f} ms  max {ms[-1]:.3f} ms")
+
+    # A burst, like a pasted list of links
+    frames_before = channel.frames_sent
+    start = time.perf_counter()
+    for i in range(burst):
+        channel.send("text", f"snippet {i}")
+    for _ in range(burst):
+        acked.acquire()
+    elapsed = time.perf_counter() - start
+    frames = channel.frames_sent - frames_before
+    print(f"burst: {burst} messages in {elapsed * 1000:.1f} ms using {frames} frames")
+
+    channel.close()
+    print(f"{'OK' if p99 < MESSAGE_TARGET_MS else 'SLOW'}: p99 target is {MESSAGE_TARGET_MS} ms")
+
+
+def bench_startup(runs=STARTUP_RUNS):
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    # Heaviest imports of the entry point, like python -X importtime
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import file_transfer_app"],
+                            cwd=here, capture_output=True, text=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            imports.append((int(parts[1]), parts[2].rstrip()))
+    print("heaviest imports (cumulative):")
+    for cumulative, name in sorted(imports, reverse=True)[:8]:
+        print(f"  {cumulative / 1000:7.1f} ms {name}")
+
+    samples = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-c", STARTUP_CHILD], cwd=here, capture_output=True, text=True)
+        samples.append(json.loads(result.stdout.strip().splitlines()[-1]))
+
+    for key, label in (("import", "import"), ("window", "time-to-window"), ("listening", "time-to-listening")):
+        values = [sample[key] * 1000 for sample in samples if sample.get(key) is not None]
+        if values:
+            print(f"{label}: median {statistics.median(values):.1f} ms  min {min(values):.1f} ms  ({len(values)} runs)")
+    if "error" in samples[0]:
+        print(f"window not measured: {samples[0]['error']}")
+
+
+BENCHMARKS = {
+    "messages": bench_messages,
+    "startup": bench_startup
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark '{name}', choose from: {', '.join(BENCHMARKS)}")
+            sys.exit(1)
+        print(f"== {name}")
+        BENCHMARKS[name]()
@@ -1,37 +1,873 @@
 import socket
 import threading
 import tkinter as tk
-from tkinter import filedialog, messagebox, ttk
+from tkinter import messagebox, ttk
 import os
 import struct
 import json
-from datetime import datetime
-import zipfile
-import tempfile
-import webbrowser
 import re
+import queue
+import sys
+import time
+import itertools
+import errno
+
+# datetime, hashlib, tempfile, webbrowser, zipfile and tkinter.filedialog are
+# imported where they're used, they add noticeably to startup on slow machines
+
+# How often the Tk main loop drains work posted by socket threads
+UI_TICK_MS = 50
+# Upper bound of queued UI callbacks handled per tick so a flood of
+# updates can't starve the event loop
+UI_BATCH_LIMIT = 200
+# How often the transfer dashboard samples progress counters
+TRANSFER_TICK_MS = 250
+# Bytes read/written per socket call during a transfer
+CHUNK_SIZE = 64 * 1024
+
+DEFAULT_SETTINGS = {
+    "open_links_incognito": True,
+    # Accept items from devices marked as trusted without asking
+    "auto_accept_trusted": True,
+    # Largest file/folder (bytes) accepted without asking, 0 = no limit
+    "auto_accept_max_size": 500 * 1024 * 1024,
+    # Where accepted items are saved, empty = ask (or ~/Downloads when auto-accepted)
+    "default_save_dir": "",
+    # Seconds an approval prompt stays open before it declines itself
+    "approval_timeout": 30,
+    # Sends running at once, further sends wait in the queue
+    "max_concurrent_sends": 3,
+    # Seconds between background rescans of shared folders
+    "share_rescan_interval": 300,
+    # Only let trusted devices browse and fetch from shared folders
+    "shares_trusted_only": False,
+    # Forward items to further devices when a sender asks us to relay
+    "allow_relay": True,
+    # Devices that get our clipboard whenever it changes
+    "clipboard_sync_peers": [],
+    # Measure every address a peer has and connect over the fastest one
+    "best_path_probe": True,
+    # Seconds a measured best path is reused before probing again
+    "path_cache_ttl": 600
+}
+
+# Extra seconds a socket thread waits past approval_timeout, leaves time to pick a save location
+APPROVAL_GRACE = 300
+# Senders put how long they wait for ACCEPT in their header (reply_timeout), receivers
+# answer this many seconds before that. Older senders don't say and wait 30 seconds
+REPLY_MARGIN = 5
+LEGACY_REPLY_TIMEOUT = 30
+
+# Sent in every header we send. Older versions (no version field) only understand
+# "file" and "link" items and show an error for anything else, so probes, message
+# channels and share browsing are only used with peers known to send this
+PROTOCOL_VERSION = 2
+
+# A probed address only counts as a peer's if it echoes a secret we gave the peer over its
+# known address. Secrets we hold for peers are answered for this long, and only to them
+PROBE_CHALLENGE_TTL = 60
+PROBE_CHALLENGES_MAX = 256
+
+# Path probing: timeout per address, RTT samples, and bytes used to measure throughput
+PROBE_TIMEOUT = 2
+PROBE_PINGS = 3
+PROBE_BYTES = 4 * 1024 * 1024
+
+# Message kinds carried by a MessageChannel
+MESSAGE_KINDS = ("link", "text", "clipboard")
+# Most messages coalesced into one frame
+MESSAGE_BATCH_LIMIT = 100
+# How often the local clipboard is checked for changes when syncing
+CLIPBOARD_POLL_MS = 500
+
+URL_PATTERN = re.compile(
+    r'^https?://'  # http:// or https://
+    r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+[A-Z]{2,6}\.?|'  # domain...
+    r'localhost|'  # localhost...
+    r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'  # ...or ip
+    r'(?::\d+)?'  # optional port
+    r'(?:/?|[/?]\S+)$', re.IGNORECASE)
+
+# Chunks a fan-out may read ahead of its slowest receiver
+FANOUT_WINDOW = 64
+# Send modes for several recipients, name -> devices each node sends to (None = all)
+FANOUT_MODES = {
+    "Direct": None,
+    "Chain relay": 1,
+    "Tree relay": 2
+}
+
+# Above this many data extents a file is sent densely, the hole map would get too big
+MAX_SPARSE_EXTENTS = 100000
+
+# Files listed per page when browsing a peer's share
+SHARE_PAGE_SIZE = 500
+
+
+def normalize_ip(ip):
+    """Strip the prefix a dual-stack socket puts on IPv4 peers (::ffff:1.2.3.4)"""
+    if ip.startswith("::ffff:") and "." in ip:
+        return ip[len("::ffff:"):]
+    return ip
+
+
+def list_local_addresses():
+    """Every non-loopback address of this machine, the default routes' first.
+    
+    Link-local IPv6 addresses are left out since they need a scope id to be usable.
+    """
+    addresses = []
+    
+    def add(ip):
+        ip = normalize_ip(ip.split("%", 1)[0])
+        if (ip and ip not in addresses and not ip.startswith("127.")
+                and ip != "::1" and not ip.lower().startswith("fe80:")):
+            addresses.append(ip)
+    
+    # Connecting a UDP socket only picks a route, nothing is sent, so this fails fast when offline
+    for family, target in ((socket.AF_INET, "8.8.8.8"), (socket.AF_INET6, "2001:4860:4860::8888")):
+        try:
+            with socket.socket(family, socket.SOCK_DGRAM) as s:
+                s.connect((target, 80))
+                add(s.getsockname()[0])
+        except OSError:
+            pass
+    
+    try:
+        for info in socket.getaddrinfo(socket.gethostname(), None):
+            add(info[4][0])
+    except OSError:
+        pass
+    
+    # On Linux the hostname usually doesn't resolve to every interface
+    if sys.platform.startswith("linux"):
+        import fcntl
+        try:
+            interfaces = socket.if_nameindex()
+        except OSError:
+            interfaces = []
+        for _, name in interfaces:
+            try:
+                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+                    # SIOCGIFADDR
+                    packed = fcntl.ioctl(s.fileno(), 0x8915, struct.pack("256s", name[:15].encode()))
+                    add(socket.inet_ntoa(packed[20:24]))
+            except OSError:
+                pass
+        try:
+            with open("/proc/net/if_inet6") as f:
+                for line in f:
+                    add(socket.inet_ntop(socket.AF_INET6, bytes.fromhex(line.split()[0])))
+        except (OSError, ValueError, IndexError):
+            pass
+    
+    return addresses
+
+
+def create_listener(port=5555):
+    """Listening socket accepting IPv4 and IPv6 where the OS supports dual-stack"""
+    if socket.has_ipv6 and socket.has_dualstack_ipv6():
+        return socket.create_server(("::", port), family=socket.AF_INET6, backlog=5, dualstack_ipv6=True)
+    return socket.create_server(("0.0.0.0", port), backlog=5)
+
+
+def data_extents(path, size):
+    """[[offset, length], ...] of the data regions of a sparse file.
+    
+    Returns None when the file has no holes, the OS or filesystem can't report
+    them (no SEEK_DATA/SEEK_HOLE), or the map would be too big to be worth it.
+    A file that is one big hole gives [], so check the result against None.
+    """
+    if not hasattr(os, "SEEK_DATA") or size == 0:
+        return None
+    
+    extents = []
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        offset = 0
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # Nothing but a hole until the end of the file
+                    break
+                raise
+            end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+            if start >= end:
+                break
+            extents.append([start, end - start])
+            offset = end
+            if len(extents) > MAX_SPARSE_EXTENTS:
+                return None
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+    
+    if sum(length for _, length in extents) >= size:
+        return None
+    return extents
+
+
+def validate_extents(extents, size):
+    """Check a hole map received from a peer, returns its data size"""
+    if not isinstance(extents, list):
+        raise ValueError("Invalid sparse map")
+    position = 0
+    for extent in extents:
+        offset, length = extent
+        if not isinstance(offset, int) or not isinstance(length, int) or offset < position or length <= 0:
+            raise ValueError("Invalid sparse map")
+        position = offset + length
+    if position > size:
+        raise ValueError("Sparse map goes past the end of the file")
+    return sum(length for _, length in extents)
+
+
+def read_extents(f, extents):
+    """Yield the data of f region by region, raises if the file ends early"""
+    for offset, length in extents:
+        f.seek(offset)
+        remaining = length
+        while remaining:
+            data = f.read(min(CHUNK_SIZE, remaining))
+            if not data:
+                # Stopping short would leave the receiver waiting for the rest forever
+                raise OSError("File got shorter while it was being sent")
+            remaining -= len(data)
+            yield data
+
+
+def expand_sparse(chunks, extents, size):
+    """Turn the data chunks of a sparse transfer back into the full byte stream"""
+    zeros = bytes(CHUNK_SIZE)
+    
+    def holes(length):
+        while length:
+            piece = min(CHUNK_SIZE, length)
+            length -= piece
+            yield zeros[:piece]
+    
+    position = 0
+    pending = b""
+    for offset, length in extents:
+        yield from holes(offset - position)
+        remaining = length
+        while remaining:
+            if not pending:
+                pending = next(chunks, None)
+                if pending is None:
+                    return
+            piece = pending[:remaining]
+            pending = pending[len(piece):]
+            remaining -= len(piece)
+            yield piece
+        position = offset + length
+    yield from holes(size - position)
+
+
+def recv_exact(sock, size):
+    """Receive exactly size bytes or raise if the connection closes"""
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed unexpectedly")
+        data.extend(chunk)
+    return bytes(data)
+
+
+def send_json(sock, obj):
+    """Send a length-prefixed JSON message"""
+    data = json.dumps(obj).encode()
+    sock.sendall(struct.pack("!I", len(data)) + data)
+
+
+def recv_json(sock):
+    """Receive a length-prefixed JSON message"""
+    size = struct.unpack("!I", recv_exact(sock, 4))[0]
+    return json.loads(recv_exact(sock, size).decode())
+
+
+def format_size(num_bytes):
+    """Human readable byte count"""
+    for unit in ("B", "KB", "MB", "GB"):
+        if num_bytes < 1024:
+            return f"{num_bytes:.0f} {unit}" if unit == "B" else f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} TB"
+
+
+def format_eta(seconds):
+    """Human readable remaining time"""
+    if seconds is None:
+        return "--"
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+
+class TransferCancelled(Exception):
+    """Raised inside a transfer loop when the user cancels it"""
+
+
+class Transfer:
+    """Progress of one send or receive shown on the dashboard.
+    
+    bytes_done is only written by the worker thread running the transfer and
+    only read by the UI tick, so the counter needs no lock.
+    """
+    _ids = itertools.count(1)
+    
+    def __init__(self, name, peer, direction, total=0):
+        self.id = str(next(Transfer._ids))
+        self.name = name
+        self.peer = peer
+        self.direction = direction
+        self.total = total
+        self.bytes_done = 0
+        self.state = "Queued"
+        self.cancelled = False
+        self._resume = threading.Event()
+        self._resume.set()
+        
+        # Sampled on the UI tick
+        self.rate = 0.0
+        self._sample_time = None
+        self._sample_bytes = 0
+    
+    @property
+    def paused(self):
+        return not self._resume.is_set()
+    
+    @property
+    def finished(self):
+        return self.state in ("Done", "Failed", "Cancelled", "Declined")
+    
+    def pause(self):
+        self._resume.clear()
+    
+    def resume(self):
+        self._resume.set()
+    
+    def cancel(self):
+        self.cancelled = True
+        self._resume.set()
+    
+    def checkpoint(self):
+        """Called by the worker between chunks to honour pause and cancel"""
+        self._resume.wait()
+        if self.cancelled:
+            raise TransferCancelled()
+    
+    def sample(self, now):
+        """Update the smoothed transfer rate from the progress counter"""
+        done = self.bytes_done
+        if self._sample_time is not None and now > self._sample_time:
+            instant = (done - self._sample_bytes) / (now - self._sample_time)
+            self.rate = instant if not self.rate else 0.7 * self.rate + 0.3 * instant
+        self._sample_time = now
+        self._sample_bytes = done
+    
+    def eta(self):
+        """Seconds left at the current rate, None if unknown"""
+        if self.finished or self.rate <= 0 or not self.total:
+            return None
+        return max(self.total - self.bytes_done, 0) / self.rate
+
+
+def recv_reply(sock, transfer, timeout):
+    """Wait for a short reply like ACCEPT, giving up early if the transfer is cancelled"""
+    deadline = time.monotonic() + timeout
+    previous = sock.gettimeout()
+    sock.settimeout(0.5)
+    try:
+        while True:
+            if transfer.cancelled:
+                raise TransferCancelled()
+            try:
+                return sock.recv(1024).decode()
+            except socket.timeout:
+                if time.monotonic() > deadline:
+                    raise
+    finally:
+        sock.settimeout(previous)
+
+
+def parse_accept(response):
+    """Split a receiver's reply into (accepted, sparse, protocol version).
+    
+    Receivers append their version (e.g. "ACCEPT V2") only for senders whose
+    header carried one, older receivers just say "ACCEPT".
+    """
+    words = response.split()
+    if not words or words[0] != "ACCEPT":
+        return False, False, 1
+    versions = [int(word[1:]) for word in words[1:] if word[:1] == "V" and word[1:].isdigit()]
+    return True, "SPARSE" in words[1:], max(versions, default=1)
+
+
+class ChunkBuffer:
+    """Chunks read once and streamed to several consumers at their own pace.
+    
+    Consumers must be added before the first put. The producer blocks once it is
+    FANOUT_WINDOW chunks ahead of the slowest consumer, and chunks every consumer
+    has read are dropped.
+    """
+    def __init__(self, window=FANOUT_WINDOW):
+        self.window = window
+        self._cond = threading.Condition()
+        self._chunks = {}
+        self._base = 0
+        self._next = 0
+        self._positions = {}
+        self._closed = False
+        self._aborted = False
+        self._consumer_ids = itertools.count()
+    
+    def add_consumer(self):
+        with self._cond:
+            consumer = next(self._consumer_ids)
+            self._positions[consumer] = self._base
+            return consumer
+    
+    def remove_consumer(self, consumer):
+        """Stop waiting for a consumer that failed or declined"""
+        with self._cond:
+            self._positions.pop(consumer, None)
+            self._trim()
+            self._cond.notify_all()
+    
+    def put(self, chunk):
+        """Add a chunk, returns False once no consumer is left"""
+        with self._cond:
+            while self._positions and self._next - min(self._positions.values()) >= self.window:
+                self._cond.wait()
+            if not self._positions:
+                return False
+            self._chunks[self._next] = chunk
+            self._next += 1
+            self._cond.notify_all()
+            return True
+    
+    def close(self):
+        """Mark the end of the data"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+    
+    def abort(self):
+        """Make consumers fail, the data they got so far is incomplete"""
+        with self._cond:
+            if self._closed:
+                # All data is already there, let consumers finish
+                return
+            self._aborted = True
+            self._closed = True
+            self._cond.notify_all()
+    
+    def get(self, consumer):
+        """Next chunk for a consumer, None at the end of the data"""
+        with self._cond:
+            index = self._positions[consumer]
+            while index >= self._next and not self._closed:
+                self._cond.wait()
+            if self._aborted:
+                raise ConnectionError("Upstream transfer failed")
+            if index >= self._next:
+                return None
+            chunk = self._chunks[index]
+            self._positions[consumer] = index + 1
+            self._trim()
+            self._cond.notify_all()
+            return chunk
+    
+    def _trim(self):
+        low = min(self._positions.values(), default=self._next)
+        while self._base < low:
+            self._chunks.pop(self._base, None)
+            self._base += 1
+
+
+def plan_relay(targets, fanout):
+    """Split targets into (device, devices it relays to) groups.
+    
+    Each node sends to at most fanout devices and hands each of them a share of
+    the rest to forward, so with fanout >= 2 the number of hops grows with log(N).
+    """
+    if not fanout or fanout >= len(targets):
+        return [(target, []) for target in targets]
+    group_size = -(-len(targets) // fanout)
+    groups = [targets[i:i + group_size] for i in range(0, len(targets), group_size)]
+    return [(group[0], group[1:]) for group in groups]
+
+
+class MessageChannel:
+    """Persistent connection to one peer for links, text snippets and clipboard.
+    
+    Messages are acked per frame. Anything queued while a frame is in flight goes
+    out together in the next one, so a burst costs one round trip instead of a
+    connect, handshake and round trip per message.
+    
+    An ack only means the peer got the message: on_ack is told whether it was
+    shown right away or is waiting for the user there to accept it.
+    """
+    def __init__(self, peer_ip, port=5555, on_ack=None, on_error=None, resolve=None):
+        self.peer_ip = peer_ip
+        self.port = port
+        self.resolve = resolve
+        self.on_ack = on_ack
+        self.on_error = on_error
+        self.closed = False
+        self.frames_sent = 0
+        self._queue = queue.Queue()
+        self._ids = itertools.count(1)
+        self._sock = None
+        
+        thread = threading.Thread(target=self._writer_thread)
+        thread.daemon = True
+        thread.start()
+    
+    def send(self, kind, data):
+        """Queue a message, returns its id"""
+        message = {"id": next(self._ids), "kind": kind, "data": data}
+        self._queue.put((message, time.perf_counter()))
+        return message["id"]
+    
+    def close(self):
+        self.closed = True
+        self._queue.put(None)
+    
+    def _connect(self):
+        address = self.resolve(self.peer_ip) if self.resolve else self.peer_ip
+        sock = socket.create_connection((address, self.port), timeout=10)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        send_json(sock, {"type": "channel", "version": PROTOCOL_VERSION})
+        response = recv_json(sock)
+        if response.get("status") != "OK":
+            sock.close()
+            raise ConnectionError(response.get("error", "Channel refused"))
+        return sock
+    
+    def _send_batch(self, messages):
+        # Reconnect once, the peer may have restarted since the last message
+        for attempt in range(2):
+            try:
+                if self._sock is None:
+                    self._sock = self._connect()
+                send_json(self._sock, {"batch": messages})
+                self.frames_sent += 1
+                response = recv_json(self._sock)
+                return set(response["ack"]), set(response.get("pending", []))
+            except (OSError, ValueError, KeyError):
+                if self._sock:
+                    self._sock.close()
+                    self._sock = None
+                if attempt:
+                    raise
+    
+    def _writer_thread(self):
+        while not self.closed:
+            item = self._queue.get()
+            if item is None:
+                break
+            
+            batch = [item]
+            while len(batch) < MESSAGE_BATCH_LIMIT:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    break
+                batch.append(item)
+            
+            messages = [message for message, _ in batch]
+            try:
+                acked, pending = self._send_batch(messages)
+            except Exception as e:
+                if self.on_error:
+                    self.on_error(self, messages, e)
+                continue
+            
+            now = time.perf_counter()
+            if self.on_ack:
+                for message, queued_at in batch:
+                    if message["id"] in acked:
+                        self.on_ack(self, message, now - queued_at, message["id"] in pending)
+        
+        if self._sock:
+            self._sock.close()
+
+
+def new_challenge():
+    """Random id and secret for a peer to echo back when probed at another address"""
+    return {"id": os.urandom(8).hex(), "secret": os.urandom(16).hex()}
+
+
+def measure_path(address, challenge_id, port=5555):
+    """Measure (RTT in seconds, throughput in bytes/s, echoed secret) to one address of a peer"""
+    with socket.create_connection((address, port), timeout=PROBE_TIMEOUT) as sock:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        send_json(sock, {"type": "probe", "version": PROTOCOL_VERSION, "challenge_id": challenge_id})
+        secret = recv_json(sock).get("secret")
+        
+        rtts = []
+        for _ in range(PROBE_PINGS):
+            start = time.perf_counter()
+            send_json(sock, {"op": "ping"})
+            recv_json(sock)
+            rtts.append(time.perf_counter() - start)
+        rtt = min(rtts)
+        
+        start = time.perf_counter()
+        send_json(sock, {"op": "data", "size": PROBE_BYTES})
+        received = 0
+        while received < PROBE_BYTES:
+            data = sock.recv(min(CHUNK_SIZE, PROBE_BYTES - received))
+            if not data:
+                raise ConnectionError("Connection closed during probe")
+            received += len(data)
+        elapsed = time.perf_counter() - start
+    
+    return rtt, PROBE_BYTES / max(elapsed - rtt, 1e-6), secret
+
+
+def probe_secret(address, challenge_id, port=5555):
+    """Secret whatever answers probes at address holds for challenge_id, None if nothing does"""
+    try:
+        with socket.create_connection((address, port), timeout=PROBE_TIMEOUT) as sock:
+            send_json(sock, {"type": "probe", "version": PROTOCOL_VERSION, "challenge_id": challenge_id})
+            return recv_json(sock).get("secret")
+    except (OSError, ValueError):
+        return None
+
+
+def serve_channel(sock, deliver):
+    """Answer a MessageChannel: hand each frame's messages to deliver and ack the frame.
+    
+    deliver returns the ids of messages that wait for the user's approval.
+    """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    send_json(sock, {"status": "OK"})
+    while True:
+        try:
+            frame = recv_json(sock)
+        except (ConnectionError, OSError):
+            return
+        messages = [message for message in frame.get("batch", []) if isinstance(message, dict)]
+        pending = deliver(messages) or []
+        send_json(sock, {"ack": [message.get("id") for message in messages], "pending": list(pending)})
+
+
+class HashingWriter:
+    """File wrapper that hashes everything written through it"""
+    def __init__(self, f):
+        import hashlib
+        self.f = f
+        self.hasher = hashlib.sha256()
+    
+    def write(self, data):
+        self.hasher.update(data)
+        return self.f.write(data)
+    
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+
+def hash_file(path):
+    """SHA-256 of a file's contents"""
+    import hashlib
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class ShareIndex:
+    """Index of a published folder for peers to browse and fetch from.
+    
+    entries maps a relative path (always "/" separated) to [size, mtime, sha256].
+    Rescans only rehash files whose size or mtime changed, and the whole index
+    is cached to disk so a restart doesn't need to hash anything again.
+    """
+    def __init__(self, name, root, entries=None):
+        self.name = name
+        self.root = root
+        self.entries = entries or {}
+        self._search_keys = None
+        self._lock = threading.Lock()
+    
+    def to_json(self):
+        return {"root": self.root, "entries": self.entries}
+    
+    @classmethod
+    def from_json(cls, name, data):
+        return cls(name, data["root"], data.get("entries"))
+    
+    def _walk(self):
+        """Yield (relative path, stat) for every regular file, skipping symlinks"""
+        stack = [self.root]
+        while stack:
+            current = stack.pop()
+            try:
+                with os.scandir(current) as it:
+                    for entry in it:
+                        try:
+                            if entry.is_symlink():
+                                continue
+                            if entry.is_dir():
+                                stack.append(entry.path)
+                            elif entry.is_file():
+                                relpath = os.path.relpath(entry.path, self.root).replace(os.sep, "/")
+                                yield relpath, entry.stat()
+                        except OSError:
+                            continue
+            except OSError:
+                continue
+    
+    def rescan(self):
+        """Update the index from disk, returns (added, changed, removed) counts"""
+        old_entries = self.entries
+        new_entries = {}
+        added = changed = 0
+        
+        for relpath, st in self._walk():
+            old = old_entries.get(relpath)
+            if old and old[0] == st.st_size and old[1] == st.st_mtime:
+                new_entries[relpath] = old
+                continue
+            try:
+                file_hash = hash_file(os.path.join(self.root, relpath))
+            except OSError:
+                continue
+            new_entries[relpath] = [st.st_size, st.st_mtime, file_hash]
+            if old:
+                changed += 1
+            else:
+                added += 1
+        
+        removed = len(old_entries.keys() - new_entries.keys())
+        with self._lock:
+            self.entries = new_entries
+            self._search_keys = None
+        return added, changed, removed
+    
+    def stats(self):
+        entries = self.entries
+        return {"name": self.name, "files": len(entries), "size": sum(e[0] for e in entries.values())}
+    
+    def search(self, query="", offset=0, limit=SHARE_PAGE_SIZE):
+        """Case-insensitive substring search, returns (total matches, page of files)"""
+        with self._lock:
+            if self._search_keys is None:
+                self._search_keys = sorted((path.lower(), path) for path in self.entries)
+            keys = self._search_keys
+            entries = self.entries
+        
+        query = query.lower().strip()
+        matches = [path for key, path in keys if query in key] if query else [path for _, path in keys]
+        page = []
+        for path in matches[offset:offset + limit]:
+            size, mtime, file_hash = entries[path]
+            page.append({"path": path, "size": size, "mtime": mtime, "hash": file_hash})
+        return len(matches), page
+    
+    def resolve(self, relpath):
+        """(absolute path, entry) of an indexed file, (None, None) for anything not in the index"""
+        entry = self.entries.get(relpath)
+        if entry is None:
+            return None, None
+        return os.path.join(self.root, *relpath.split("/")), entry
+    
+    def refresh(self, relpath):
+        """Like resolve, but rehashes the file first if it changed since the last scan"""
+        path, entry = self.resolve(relpath)
+        if path is None:
+            return None, None
+        st = os.stat(path)
+        if entry[0] != st.st_size or entry[1] != st.st_mtime:
+            entry = [st.st_size, st.st_mtime, hash_file(path)]
+            with self._lock:
+                if relpath in self.entries:
+                    self.entries[relpath] = entry
+        return path, entry
+
+
+class ApprovalRequest:
+    """Incoming item waiting for a decision from the UI thread, for at most timeout seconds"""
+    def __init__(self, addr, item_info, timeout=None):
+        self.addr = addr
+        self.item_info = item_info
+        self.timeout = timeout
+        self.accepted = False
+        self.target = None
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+    
+    def resolve(self, accepted, target=None):
+        """Record the decision; only the first call counts, returns whether this one did"""
+        with self._lock:
+            if self._done.is_set():
+                return False
+            self.accepted = accepted
+            self.target = target
+            self._done.set()
+            return True
+    
+    @property
+    def decided(self):
+        return self._done.is_set()
+    
+    def wait(self, timeout=None):
+        """Block the calling socket thread until a decision is made"""
+        if not self._done.wait(timeout):
+            self.resolve(False)
+        return self.accepted
+
 
 class FileTransferApp:
     def __init__(self, root):
         self.root = root
         self.root.title("Network File & Link Transfer")
-        self.root.geometry("650x450")
+        self.root.geometry("720x740")
         self.root.configure(bg="#2b2b2b")
         
-        # Get local IP
+        # Local IPs are detected in the background, peers probing for the fastest path get all of them
+        self.local_addresses = []
         self.local_ip = self.get_local_ip()
         
-        # Server thread
+        # Best address per peer, peer ip -> (address, expiry), and peers being probed right now
+        self.path_cache = {}
+        self.path_probes = set()
+        self.path_lock = threading.Lock()
+        # Challenges peers gave us to echo when probed, id -> (secret, addresses allowed to ask, expiry)
+        self.probe_challenges = {}
+        self.probe_lock = threading.Lock()
+        # Protocol version each peer has shown it speaks, peer ip -> version
+        self.peer_versions = {}
+        
+        # Server thread, server_ready is set once we accept connections
         self.server_thread = None
         self.server_running = False
+        self.server_ready = threading.Event()
         
-        # Devices history
+        # Devices history, loaded on first use
         self.devices_file = "devices_history.json"
-        self.devices = self.load_devices()
+        self._devices = None
         
-        # Settings file
+        # Settings file, loaded on first use
         self.settings_file = "transfer_settings.json"
-        self.settings = self.load_settings()
+        self._settings = None
+        
+        # Shared folders for pull mode, name -> ShareIndex
+        self.shares_file = "share_index.json"
+        self.shares = {}
+        self.shares_lock = threading.Lock()
+        self.rescan_event = threading.Event()
         
         # Dropdown state
         self.dropdown_window = None
@@ -39,6 +875,21 @@ class FileTransferApp:
         # Link data
         self.current_link = None
         
+        # Persistent message channels for links, text and clipboard, peer ip -> MessageChannel
+        self.channels = {}
+        self.last_clipboard = None
+        # Untrusted messages waiting in a prompt, peer ip -> ApprovalRequest
+        self.pending_messages = {}
+        self.pending_lock = threading.Lock()
+        
+        # Work posted by socket threads, drained on the Tk main loop
+        self.ui_queue = queue.Queue()
+        
+        # Active and finished transfers shown on the dashboard
+        self.transfers = {}
+        # Created with the background tasks, it needs the settings file
+        self.send_slots = None
+        
         # Style configuration
         style = ttk.Style()
         style.theme_use('clam')
@@ -46,19 +897,100 @@ class FileTransferApp:
         style.map("TButton", background=[('active', '#357abd')])
         style.configure("TLabel", background="#2b2b2b", foreground="white", font=("Arial", 10))
         style.configure("TEntry", fieldbackground="#3c3c3c", foreground="white")
+        style.configure("Treeview", background="#3c3c3c", fieldbackground="#3c3c3c", foreground="white",
+                        rowheight=22, borderwidth=0, font=("Arial", 9))
+        style.configure("Treeview.Heading", background="#2b2b2b", foreground="#4a90e2", relief="flat",
+                        font=("Arial", 9, "bold"))
+        style.map("Treeview", background=[('selected', '#4a90e2')])
         
         self.create_ui()
+        self.root.after(UI_TICK_MS, self._drain_ui_queue)
+        self.root.after(TRANSFER_TICK_MS, self._refresh_transfers)
+        self.root.after(CLIPBOARD_POLL_MS, self._poll_clipboard)
+        # Networking and indexing start once the window is up
+        self.root.after_idle(self.start_background_tasks)
+    
+    def start_background_tasks(self):
+        # Settings are first read here, not while the window is being built
+        self.send_slots = threading.Semaphore(max(1, int(self.settings.get("max_concurrent_sends", 3))))
+        self.update_incognito_button()
         self.start_server()
+        thread = threading.Thread(target=self._detect_addresses_thread)
+        thread.daemon = True
+        thread.start()
+        self.start_share_indexer()
+    
+    def _detect_addresses_thread(self):
+        self.local_addresses = list_local_addresses()
+        self.local_ip = self.get_local_ip()
+        self.post_ui(self.update_ip_labels)
+    
+    def post_ui(self, func, *args):
+        """Run func(*args) on the Tk main loop (safe to call from any thread)"""
+        self.ui_queue.put(("call", (func, args)))
+    
+    def set_status(self, text, fg):
+        """Update the status label from any thread"""
+        self.ui_queue.put(("status", (text, fg)))
+    
+    def _drain_ui_queue(self):
+        """Apply queued UI work in one batch per tick"""
+        # Reschedule first so a modal dialog opened by a callback below
+        # doesn't stop the queue from being drained
+        self.root.after(UI_TICK_MS, self._drain_ui_queue)
+        
+        status = None
+        for _ in range(UI_BATCH_LIMIT):
+            try:
+                kind, payload = self.ui_queue.get_nowait()
+            except queue.Empty:
+                break
+            
+            if kind == "status":
+                # Only the latest status before the next callback is visible anyway
+                status = payload
+                continue
+            
+            # A callback may open a modal dialog that runs nested ticks with newer
+            # statuses, ours must be applied before it or it'd overwrite those after
+            if status:
+                self._apply_status(status)
+                status = None
+            func, args = payload
+            try:
+                func(*args)
+            except Exception as e:
+                print(f"Error in UI callback: {e}")
         
+        if status:
+            self._apply_status(status)
+    
+    def _apply_status(self, status):
+        text, fg = status
+        self.status_label.config(text=text, fg=fg)
+    
     def get_local_ip(self):
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.connect(("8.8.8.8", 80))
-            ip = s.getsockname()[0]
-            s.close()
-            return ip
-        except:
-            return "127.0.0.1"
+        return self.local_addresses[0] if self.local_addresses else "127.0.0.1"
+    
+    @property
+    def devices(self):
+        if self._devices is None:
+            self._devices = self.load_devices()
+        return self._devices
+    
+    @devices.setter
+    def devices(self, devices):
+        self._devices = devices
+    
+    @property
+    def settings(self):
+        if self._settings is None:
+            self._settings = self.load_settings()
+        return self._settings
+    
+    @settings.setter
+    def settings(self, settings):
+        self._settings = settings
     
     def load_devices(self):
         try:
@@ -77,13 +1009,14 @@ class FileTransferApp:
             print(f"Error saving devices: {e}")
     
     def load_settings(self):
+        settings = dict(DEFAULT_SETTINGS)
         try:
             if os.path.exists(self.settings_file):
                 with open(self.settings_file, 'r') as f:
-                    return json.load(f)
+                    settings.update(json.load(f))
         except:
             pass
-        return {"open_links_incognito": True}
+        return settings
     
     def save_settings(self):
         try:
@@ -92,7 +1025,27 @@ class FileTransferApp:
         except Exception as e:
             print(f"Error saving settings: {e}")
     
+    def load_shares(self):
+        try:
+            if os.path.exists(self.shares_file):
+                with open(self.shares_file, 'r') as f:
+                    data = json.load(f)
+                return {name: ShareIndex.from_json(name, share) for name, share in data.items()}
+        except Exception as e:
+            print(f"Error loading shares: {e}")
+        return {}
+    
+    def save_shares(self):
+        try:
+            with self.shares_lock:
+                data = {name: share.to_json() for name, share in list(self.shares.items())}
+                with open(self.shares_file, 'w') as f:
+                    json.dump(data, f)
+        except Exception as e:
+            print(f"Error saving shares: {e}")
+    
     def add_device(self, ip, name=None):
+        from datetime import datetime
         # Check if device already exists
         for device in self.devices:
             if device['ip'] == ip:
@@ -111,8 +1064,82 @@ class FileTransferApp:
         }
         self.devices.insert(0, device)
         
-        # Keep only last 3 devices
-        self.devices = self.devices[:3]
+        # Keep only last 3 devices, trusted devices are never dropped
+        self.devices = [d for i, d in enumerate(self.devices) if i < 3 or d.get('trusted')]
+        self.save_devices()
+    
+    def is_trusted(self, ip):
+        """Check if a device from history is marked as trusted"""
+        return any(d.get('trusted') and (d['ip'] == ip or ip in d.get('addresses', [])) for d in self.devices)
+    
+    def peer_version(self, ip):
+        """Protocol version a peer has shown it speaks, 1 (files and links only) until we know"""
+        if ip in self.peer_versions:
+            return self.peer_versions[ip]
+        return max([d.get('version', 1) for d in self.devices if d['ip'] == ip], default=1)
+    
+    def note_peer_version(self, ip, version):
+        """Remember the version from a peer's header or reply, kept in history for known devices"""
+        if not isinstance(version, int) or self.peer_version(ip) == version:
+            return
+        self.peer_versions[ip] = version
+        for device in self.devices:
+            if device['ip'] == ip:
+                device['version'] = version
+                self.post_ui(self.save_devices)
+    
+    def claimed_device_addresses(self, ip, addresses):
+        """Other addresses a trusted device says it has, empty for anyone else"""
+        if not isinstance(addresses, list) or not any(d['ip'] == ip and d.get('trusted') for d in self.devices):
+            return []
+        # A handful is plenty, each one costs a connection
+        return [address for address in addresses[:16]
+                if isinstance(address, str) and address != ip and address not in self.local_addresses]
+    
+    def learn_device_addresses(self, ip, claimed, challenge):
+        """Remember the other addresses of a trusted device, it may connect from any of them.
+        
+        The device got the challenge over its own address, and an address is only kept if
+        it echoes the secret. Claiming someone else's address doesn't get that machine
+        trusted, and the device only echoes to our addresses so relaying to it fails too.
+        """
+        verified = [address for address in claimed if probe_secret(address, challenge["id"]) == challenge["secret"]]
+        device = next((d for d in self.devices if d['ip'] == ip and d.get('trusted')), None)
+        if device is not None and device.get('addresses', []) != verified:
+            device['addresses'] = verified
+            self.post_ui(self.save_devices)
+    
+    def remember_challenge(self, challenge, addresses):
+        """Keep a peer's challenge to echo when it probes us from one of addresses"""
+        if (not isinstance(challenge, dict) or not isinstance(challenge.get("id"), str)
+                or not isinstance(challenge.get("secret"), str)):
+            return
+        allowed = {address for address in addresses if isinstance(address, str)}
+        now = time.monotonic()
+        with self.probe_lock:
+            for challenge_id in [c for c, entry in self.probe_challenges.items() if entry[2] < now]:
+                del self.probe_challenges[challenge_id]
+            if len(self.probe_challenges) >= PROBE_CHALLENGES_MAX:
+                del self.probe_challenges[next(iter(self.probe_challenges))]
+            # First one wins, someone who saw the id can't swap in their own secret
+            self.probe_challenges.setdefault(challenge["id"], (challenge["secret"], allowed, now + PROBE_CHALLENGE_TTL))
+    
+    def challenge_secret(self, challenge_id, ip):
+        """Secret to echo for challenge_id, None unless ip is one the challenge came with"""
+        if not isinstance(challenge_id, str):
+            return None
+        with self.probe_lock:
+            entry = self.probe_challenges.get(challenge_id)
+        if entry is None or ip not in entry[1] or entry[2] < time.monotonic():
+            return None
+        return entry[0]
+    
+    def set_device_trusted(self, ip, trusted=True):
+        """Mark a device as trusted, adding it to history if needed"""
+        self.add_device(ip)
+        for device in self.devices:
+            if device['ip'] == ip:
+                device['trusted'] = trusted
         self.save_devices()
     
     def show_device_dropdown(self, event=None):
@@ -173,14 +1200,7 @@ class FileTransferApp:
     
     def is_valid_url(self, url):
         """Check if string is a valid URL"""
-        url_pattern = re.compile(
-            r'^https?://'  # http:// or https://
-            r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+[A-Z]{2,6}\.?|'  # domain...
-            r'localhost|'  # localhost...
-            r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'  # ...or ip
-            r'(?::\d+)?'  # optional port
-            r'(?:/?|[/?]\S+)$', re.IGNORECASE)
-        return url_pattern.match(url) is not None
+        return URL_PATTERN.match(url) is not None
     
     def toggle_incognito(self):
         """Toggle incognito mode preference"""
@@ -294,6 +1314,13 @@ class FileTransferApp:
         link_entry.bind("<Return>", lambda e: save_link())
         link_entry.bind("<Escape>", lambda e: link_dialog.destroy())
     
+    def update_ip_labels(self):
+        self.ip_value.config(text=self.local_ip)
+        other_addresses = [ip for ip in self.local_addresses if ip != self.local_ip]
+        if other_addresses:
+            self.other_ips_label.config(
+                text="also: " + ", ".join(other_addresses[:3]) + (" ..." if len(other_addresses) > 3 else ""))
+    
     def add_hover_effect(self, button, bg_color):
         """Add white outline on hover"""
         button.bind("<Enter>", lambda e: button.config(highlightthickness=2, highlightbackground="white", highlightcolor="white"))
@@ -317,9 +1344,9 @@ class FileTransferApp:
         ip_label = ttk.Label(ip_frame, text="Your IP Address:", font=("Arial", 11, "bold"))
         ip_label.pack(side=tk.LEFT, padx=5)
         
-        ip_value = tk.Label(
+        self.ip_value = tk.Label(
             ip_frame,
-            text=self.local_ip,
+            text="detecting...",
             font=("Arial", 12, "bold"),
             bg="#3c3c3c",
             fg="#4ade80",
@@ -327,7 +1354,16 @@ class FileTransferApp:
             pady=5,
             relief=tk.RAISED
         )
-        ip_value.pack(side=tk.LEFT, padx=5)
+        self.ip_value.pack(side=tk.LEFT, padx=5)
+        
+        self.other_ips_label = tk.Label(
+            ip_frame,
+            text="",
+            bg="#2b2b2b",
+            fg="#888888",
+            font=("Arial", 9)
+        )
+        self.other_ips_label.pack(side=tk.LEFT, padx=5)
         
         # Separator
         sep = tk.Frame(self.root, height=2, bg="#4a90e2")
@@ -348,6 +1384,12 @@ class FileTransferApp:
                                    width=30, anchor=tk.W, padx=5, font=("Arial", 9))
         self.file_label.grid(row=1, column=1, padx=10, pady=5, sticky=tk.W)
         
+        # How to reach several recipients (separate IPs with commas)
+        ttk.Label(send_frame, text="Multiple IPs:", font=("Arial", 10)).grid(row=2, column=0, sticky=tk.W, pady=5)
+        self.fanout_mode = tk.StringVar(value="Direct")
+        ttk.Combobox(send_frame, textvariable=self.fanout_mode, values=list(FANOUT_MODES),
+                     state="readonly", width=15).grid(row=2, column=1, padx=10, pady=5, sticky=tk.W)
+        
         # Buttons - using grid for center anchoring
         button_container = tk.Frame(self.root, bg="#2b2b2b")
         button_container.pack(pady=15)
@@ -423,7 +1465,6 @@ class FileTransferApp:
         )
         self.incognito_btn.pack(side=tk.LEFT, padx=0)
         self.add_hover_effect(self.incognito_btn, "#4ade80")
-        self.update_incognito_button()
         
         send_btn = tk.Button(
             button_container,
@@ -441,31 +1482,196 @@ class FileTransferApp:
         send_btn.grid(row=0, column=3, padx=5)
         self.add_hover_effect(send_btn, "#4ade80")
         
-        # Info label
-        info_label = tk.Label(
-            self.root,
-            text="💡 Send files, folders, or links • Links auto-open in new tab",
-            bg="#2b2b2b",
-            fg="#888888",
-            font=("Arial", 9, "italic")
+        # Pull mode
+        shares_btn = tk.Button(
+            button_container,
+            text="📤 Shared Folders",
+            command=self.show_shares_dialog,
+            bg="#666666",
+            fg="white",
+            font=("Arial", 10, "bold"),
+            padx=12,
+            pady=8,
+            relief=tk.FLAT,
+            cursor="hand2",
+            borderwidth=0
         )
-        info_label.pack(pady=5)
+        shares_btn.grid(row=1, column=0, padx=5, pady=(8, 0))
+        self.add_hover_effect(shares_btn, "#666666")
         
-        # Status
-        self.status_label = tk.Label(
-            self.root,
-            text="Listening for incoming files and links...",
-            bg="#2b2b2b",
-            fg="#888888",
-            font=("Arial", 9, "italic")
+        browse_peer_btn = tk.Button(
+            button_container,
+            text="🌐 Browse Peer",
+            command=self.browse_peer,
+            bg="#666666",
+            fg="white",
+            font=("Arial", 10, "bold"),
+            padx=12,
+            pady=8,
+            relief=tk.FLAT,
+            cursor="hand2",
+            borderwidth=0
+        )
+        browse_peer_btn.grid(row=1, column=1, padx=5, pady=(8, 0))
+        self.add_hover_effect(browse_peer_btn, "#666666")
+        
+        # Quick messages over the persistent channel
+        send_clipboard_btn = tk.Button(
+            button_container,
+            text="📋 Send Clipboard",
+            command=self.send_clipboard,
+            bg="#666666",
+            fg="white",
+            font=("Arial", 10, "bold"),
+            padx=12,
+            pady=8,
+            relief=tk.FLAT,
+            cursor="hand2",
+            borderwidth=0
+        )
+        send_clipboard_btn.grid(row=1, column=2, padx=5, pady=(8, 0))
+        self.add_hover_effect(send_clipboard_btn, "#666666")
+        
+        send_text_btn = tk.Button(
+            button_container,
+            text="📝 Send Text",
+            command=self.send_text,
+            bg="#666666",
+            fg="white",
+            font=("Arial", 10, "bold"),
+            padx=12,
+            pady=8,
+            relief=tk.FLAT,
+            cursor="hand2",
+            borderwidth=0
+        )
+        send_text_btn.grid(row=1, column=3, padx=5, pady=(8, 0))
+        self.add_hover_effect(send_text_btn, "#666666")
+        
+        # Info label
+        info_label = tk.Label(
+            self.root,
+            text="💡 Send files, folders, or links • Links auto-open in new tab",
+            bg="#2b2b2b",
+            fg="#888888",
+            font=("Arial", 9, "italic")
+        )
+        info_label.pack(pady=5)
+        
+        # Status
+        self.status_label = tk.Label(
+            self.root,
+            text="Listening for incoming files and links...",
+            bg="#2b2b2b",
+            fg="#888888",
+            font=("Arial", 9, "italic")
         )
         self.status_label.pack(pady=10)
         
+        # Transfers dashboard
+        transfers_frame = tk.Frame(self.root, bg="#2b2b2b")
+        transfers_frame.pack(pady=5, padx=20, fill=tk.BOTH, expand=True)
+        
+        columns = ("item", "peer", "progress", "rate", "eta", "state")
+        self.transfers_tree = ttk.Treeview(transfers_frame, columns=columns, show="headings", height=6)
+        for column, heading, width in (
+            ("item", "Item", 200),
+            ("peer", "Peer", 110),
+            ("progress", "Progress", 140),
+            ("rate", "Rate", 80),
+            ("eta", "ETA", 60),
+            ("state", "State", 80)
+        ):
+            self.transfers_tree.heading(column, text=heading)
+            self.transfers_tree.column(column, width=width, anchor=tk.W)
+        self.transfers_tree.pack(fill=tk.BOTH, expand=True)
+        
+        transfer_buttons = tk.Frame(self.root, bg="#2b2b2b")
+        transfer_buttons.pack(pady=(5, 10))
+        
+        for text, command in (
+            ("⏯ Pause/Resume", self.toggle_pause_selected),
+            ("✖ Cancel", self.cancel_selected),
+            ("🧹 Clear Finished", self.clear_finished)
+        ):
+            btn = tk.Button(
+                transfer_buttons,
+                text=text,
+                command=command,
+                bg="#666666",
+                fg="white",
+                font=("Arial", 9),
+                padx=10,
+                pady=3,
+                relief=tk.FLAT,
+                cursor="hand2",
+                borderwidth=0
+            )
+            btn.pack(side=tk.LEFT, padx=5)
+            self.add_hover_effect(btn, "#666666")
+        
         self.selected_file = None
         self.selected_folder = None
         self.is_folder = False
     
+    def add_transfer(self, transfer):
+        """Register a transfer with the dashboard (safe to call from any thread)"""
+        self.transfers[transfer.id] = transfer
+        return transfer
+    
+    def _refresh_transfers(self):
+        """Sample all progress counters and redraw the dashboard on a fixed tick"""
+        self.root.after(TRANSFER_TICK_MS, self._refresh_transfers)
+        now = time.monotonic()
+        
+        for transfer in list(self.transfers.values()):
+            transfer.sample(now)
+            
+            if transfer.total:
+                percent = min(100, transfer.bytes_done * 100 // transfer.total)
+                progress = f"{format_size(transfer.bytes_done)} / {format_size(transfer.total)} ({percent}%)"
+            else:
+                progress = format_size(transfer.bytes_done)
+            state = "Paused" if transfer.paused and not transfer.finished else transfer.state
+            rate = f"{format_size(transfer.rate)}/s" if transfer.state in ("Sending", "Receiving") else ""
+            values = (
+                f"{transfer.direction} {transfer.name}",
+                transfer.peer,
+                progress,
+                rate,
+                format_eta(transfer.eta()),
+                state
+            )
+            
+            if not self.transfers_tree.exists(transfer.id):
+                self.transfers_tree.insert("", tk.END, iid=transfer.id, values=values)
+            elif self.transfers_tree.item(transfer.id, "values") != values:
+                self.transfers_tree.item(transfer.id, values=values)
+    
+    def selected_transfers(self):
+        return [self.transfers[iid] for iid in self.transfers_tree.selection() if iid in self.transfers]
+    
+    def toggle_pause_selected(self):
+        for transfer in self.selected_transfers():
+            if transfer.paused:
+                transfer.resume()
+            elif not transfer.finished:
+                transfer.pause()
+    
+    def cancel_selected(self):
+        for transfer in self.selected_transfers():
+            if not transfer.finished:
+                transfer.cancel()
+    
+    def clear_finished(self):
+        for transfer in list(self.transfers.values()):
+            if transfer.finished:
+                del self.transfers[transfer.id]
+                if self.transfers_tree.exists(transfer.id):
+                    self.transfers_tree.delete(transfer.id)
+    
     def browse_file(self):
+        from tkinter import filedialog
         filename = filedialog.askopenfilename(title="Select a file to send")
         if filename:
             self.selected_file = filename
@@ -475,6 +1681,7 @@ class FileTransferApp:
             self.file_label.config(text=os.path.basename(filename), fg="white")
     
     def browse_folder(self):
+        from tkinter import filedialog
         foldername = filedialog.askdirectory(title="Select a folder to send")
         if foldername:
             self.selected_folder = foldername
@@ -484,20 +1691,306 @@ class FileTransferApp:
             folder_name = os.path.basename(foldername)
             self.file_label.config(text=f"📁 {folder_name}", fg="white")
     
-    def zip_folder(self, folder_path):
-        """Create a temporary zip file of the folder"""
+    def show_shares_dialog(self):
+        """Manage the folders published for peers to browse"""
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Shared Folders")
+        dialog.geometry("520x300")
+        dialog.configure(bg="#2b2b2b")
+        dialog.transient(self.root)
+        
+        tk.Label(
+            dialog,
+            text="Folders peers can browse and download from:",
+            bg="#2b2b2b",
+            fg="white",
+            font=("Arial", 11, "bold")
+        ).pack(pady=10)
+        
+        share_list = tk.Listbox(
+            dialog,
+            bg="#3c3c3c",
+            fg="white",
+            selectbackground="#4a90e2",
+            font=("Arial", 9),
+            relief=tk.FLAT
+        )
+        share_list.pack(padx=20, fill=tk.BOTH, expand=True)
+        
+        def refresh():
+            if not dialog.winfo_exists():
+                return
+            rows = []
+            for share in list(self.shares.values()):
+                stats = share.stats()
+                rows.append(f"{share.name} — {stats['files']} files, {format_size(stats['size'])} — {share.root}")
+            if list(share_list.get(0, tk.END)) != rows:
+                selection = share_list.curselection()
+                share_list.delete(0, tk.END)
+                for row in rows:
+                    share_list.insert(tk.END, row)
+                for index in selection:
+                    share_list.selection_set(index)
+            # Pick up progress of the background indexer
+            dialog.after(1000, refresh)
+        
+        def add():
+            from tkinter import filedialog
+            folder = filedialog.askdirectory(title="Select a folder to share", parent=dialog)
+            if folder:
+                self.add_share(folder)
+        
+        def remove():
+            names = list(self.shares)
+            for index in share_list.curselection():
+                if index < len(names):
+                    self.remove_share(names[index])
+        
+        button_frame = tk.Frame(dialog, bg="#2b2b2b")
+        button_frame.pack(pady=10)
+        
+        for text, command, color in (
+            ("➕ Add", add, "#4a90e2"),
+            ("➖ Remove", remove, "#666666"),
+            ("🔄 Rescan Now", self.rescan_event.set, "#666666")
+        ):
+            tk.Button(
+                button_frame,
+                text=text,
+                command=command,
+                bg=color,
+                fg="white",
+                font=("Arial", 10),
+                padx=15,
+                pady=5,
+                relief=tk.FLAT,
+                cursor="hand2"
+            ).pack(side=tk.LEFT, padx=5)
+        
+        refresh()
+    
+    def browse_peer(self):
+        """Browse and download from the shared folders of the peer in the IP field"""
+        peer_ip = self.ip_entry.get().strip()
+        if not peer_ip:
+            messagebox.showwarning("No IP", "Please enter the IP address of the device to browse!")
+            return
+        if self.peer_version(peer_ip) < PROTOCOL_VERSION:
+            messagebox.showwarning("Can't Browse", f"{peer_ip} hasn't shown it runs a version with shared folders.\n\n"
+                                   "Send it a file or link first (or update NetTransfer there).")
+            return
+        
+        dialog = tk.Toplevel(self.root)
+        dialog.title(f"Shared by {peer_ip}")
+        dialog.geometry("620x460")
+        dialog.configure(bg="#2b2b2b")
+        dialog.transient(self.root)
+        
+        top_frame = tk.Frame(dialog, bg="#2b2b2b")
+        top_frame.pack(pady=10, padx=20, fill=tk.X)
+        
+        share_var = tk.StringVar()
+        share_box = ttk.Combobox(top_frame, textvariable=share_var, state="readonly", width=20)
+        share_box.pack(side=tk.LEFT)
+        
+        search_entry = tk.Entry(top_frame, bg="#3c3c3c", fg="white", insertbackground="white", font=("Arial", 10))
+        search_entry.pack(side=tk.LEFT, padx=10, fill=tk.X, expand=True)
+        
+        files_tree = ttk.Treeview(dialog, columns=("path", "size"), show="headings")
+        files_tree.heading("path", text="File")
+        files_tree.heading("size", text="Size")
+        files_tree.column("path", width=460, anchor=tk.W)
+        files_tree.column("size", width=100, anchor=tk.W)
+        files_tree.pack(padx=20, fill=tk.BOTH, expand=True)
+        
+        status_label = tk.Label(dialog, text="Connecting...", bg="#2b2b2b", fg="#888888", font=("Arial", 9))
+        status_label.pack(pady=5)
+        
+        # Current listing, the latest search wins if several are in flight
+        state = {"files": [], "total": 0, "query_id": 0, "search_after": None}
+        
+        def set_status(text):
+            if dialog.winfo_exists():
+                status_label.config(text=text)
+        
+        def show_page(query_id, total, files, append):
+            if query_id != state["query_id"] or not dialog.winfo_exists():
+                return
+            if not append:
+                files_tree.delete(*files_tree.get_children())
+                state["files"] = []
+            for file in files:
+                files_tree.insert("", tk.END, iid=str(len(state["files"])), values=(file["path"], format_size(file["size"])))
+                state["files"].append(file)
+            state["total"] = total
+            set_status(f"Showing {len(state['files'])} of {total} files")
+        
+        def load(append=False):
+            share = share_var.get()
+            if not share:
+                return
+            if not append:
+                state["query_id"] += 1
+            query_id = state["query_id"]
+            query = search_entry.get()
+            offset = len(state["files"]) if append else 0
+            
+            def worker():
+                try:
+                    total, files = self.search_peer_share(peer_ip, share, query, offset)
+                    self.post_ui(show_page, query_id, total, files, append)
+                except Exception as e:
+                    self.post_ui(set_status, f"✗ {e}")
+            
+            threading.Thread(target=worker, daemon=True).start()
+        
+        def on_search(event=None):
+            # Debounce typing so each keystroke doesn't hit the network
+            if state["search_after"]:
+                dialog.after_cancel(state["search_after"])
+            state["search_after"] = dialog.after(300, load)
+        
+        def show_shares(shares):
+            if not dialog.winfo_exists():
+                return
+            share_box["values"] = [share["name"] for share in shares]
+            if shares:
+                share_box.current(0)
+                load()
+            else:
+                set_status(f"{peer_ip} isn't sharing any folders")
+        
+        def fetch_shares():
+            try:
+                self.post_ui(show_shares, self.list_peer_shares(peer_ip))
+            except Exception as e:
+                self.post_ui(set_status, f"✗ {e}")
+        
+        def download():
+            from tkinter import filedialog
+            files = [state["files"][int(iid)] for iid in files_tree.selection()]
+            if not files:
+                return
+            save_dir = self.settings.get("default_save_dir") or filedialog.askdirectory(
+                title="Select where to save", parent=dialog)
+            if not save_dir:
+                return
+            for file in files:
+                # Reserved now, two selected files with the same name must not share a path
+                save_path = self.reserve_path(save_dir, os.path.basename(file["path"]))
+                transfer = self.add_transfer(Transfer(os.path.basename(file["path"]), peer_ip, "⬇", file["size"]))
+                thread = threading.Thread(target=self._fetch_thread,
+                                          args=(peer_ip, share_var.get(), file["path"], save_path, transfer))
+                thread.daemon = True
+                thread.start()
+        
+        share_box.bind("<<ComboboxSelected>>", lambda e: load())
+        search_entry.bind("<KeyRelease>", on_search)
+        files_tree.bind("<Double-1>", lambda e: download())
+        
+        button_frame = tk.Frame(dialog, bg="#2b2b2b")
+        button_frame.pack(pady=10)
+        
+        for text, command, color in (
+            ("⬇ Download", download, "#4ade80"),
+            ("More", lambda: load(append=True) if len(state["files"]) < state["total"] else None, "#666666")
+        ):
+            tk.Button(
+                button_frame,
+                text=text,
+                command=command,
+                bg=color,
+                fg="white",
+                font=("Arial", 10, "bold"),
+                padx=15,
+                pady=5,
+                relief=tk.FLAT,
+                cursor="hand2"
+            ).pack(side=tk.LEFT, padx=5)
+        
+        threading.Thread(target=fetch_shares, daemon=True).start()
+    
+    def zip_folder(self, folder_path, cancelled=None):
+        """Create a temporary zip file of the folder, cancelled() is checked between files"""
+        import tempfile
+        import zipfile
         temp_zip = tempfile.NamedTemporaryFile(delete=False, suffix='.zip')
         temp_zip.close()
         
-        with zipfile.ZipFile(temp_zip.name, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for root, dirs, files in os.walk(folder_path):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, os.path.dirname(folder_path))
-                    zipf.write(file_path, arcname)
+        try:
+            with zipfile.ZipFile(temp_zip.name, 'w', zipfile.ZIP_DEFLATED) as zipf:
+                for root, dirs, files in os.walk(folder_path):
+                    for file in files:
+                        if cancelled and cancelled():
+                            raise TransferCancelled()
+                        file_path = os.path.join(root, file)
+                        arcname = os.path.relpath(file_path, os.path.dirname(folder_path))
+                        zipf.write(file_path, arcname)
+        except:
+            os.unlink(temp_zip.name)
+            raise
         
         return temp_zip.name
     
+    def get_recipients(self):
+        """IPs in the recipient field, several can be separated with commas"""
+        return [ip for ip in re.split(r"[,;\s]+", self.ip_entry.get()) if ip]
+    
+    def send_clipboard(self):
+        recipients = self.get_recipients()
+        if not recipients:
+            messagebox.showwarning("No IP", "Please enter recipient IP address!")
+            return
+        try:
+            text = self.root.clipboard_get()
+        except tk.TclError:
+            messagebox.showwarning("Empty Clipboard", "There is no text on the clipboard!")
+            return
+        for recipient_ip in recipients:
+            self.add_device(recipient_ip)
+        self.send_message(recipients, "clipboard", text)
+    
+    def send_text(self):
+        """Show a popup to type a text snippet for the recipients"""
+        recipients = self.get_recipients()
+        if not recipients:
+            messagebox.showwarning("No IP", "Please enter recipient IP address!")
+            return
+        
+        text_dialog = tk.Toplevel(self.root)
+        text_dialog.title("Send Text")
+        text_dialog.geometry("450x250")
+        text_dialog.configure(bg="#2b2b2b")
+        text_dialog.transient(self.root)
+        
+        text_box = tk.Text(text_dialog, bg="#3c3c3c", fg="white", insertbackground="white", font=("Arial", 10), wrap=tk.WORD)
+        text_box.pack(padx=10, pady=10, fill=tk.BOTH, expand=True)
+        text_box.focus()
+        
+        def send():
+            text = text_box.get("1.0", "end-1c")
+            if not text.strip():
+                return
+            for recipient_ip in recipients:
+                self.add_device(recipient_ip)
+            self.send_message(recipients, "text", text)
+            text_dialog.destroy()
+        
+        tk.Button(
+            text_dialog,
+            text="📤 Send",
+            command=send,
+            bg="#4ade80",
+            fg="white",
+            font=("Arial", 10, "bold"),
+            padx=20,
+            pady=5,
+            relief=tk.FLAT,
+            cursor="hand2"
+        ).pack(pady=(0, 10))
+        
+        text_box.bind("<Control-Return>", lambda e: send())
+    
     def send_item(self):
         """Send file, folder, or link"""
         is_link = bool(self.current_link)
@@ -507,11 +2000,16 @@ class FileTransferApp:
             messagebox.showwarning("No Selection", "Please select a file, folder, or link to send!")
             return
         
-        recipient_ip = self.ip_entry.get().strip()
-        if not recipient_ip:
+        recipients = self.get_recipients()
+        if not recipients:
             messagebox.showwarning("No IP", "Please enter recipient IP address!")
             return
         
+        if len(recipients) > 1:
+            self.send_to_many(recipients, is_link)
+            return
+        recipient_ip = recipients[0]
+        
         # Ask for device name if it's a new device
         device_exists = any(d['ip'] == recipient_ip for d in self.devices)
         if not device_exists:
@@ -563,126 +2061,521 @@ class FileTransferApp:
             self.add_device(recipient_ip)
         
         if is_link:
-            thread = threading.Thread(target=self._send_link_thread, args=(recipient_ip, self.current_link))
+            self.send_message([recipient_ip], "link", self.current_link)
         else:
-            thread = threading.Thread(target=self._send_file_thread, args=(recipient_ip,))
+            path = self.selected_folder if self.is_folder else self.selected_file
+            name = os.path.basename(path)
+            transfer = self.add_transfer(Transfer(name, recipient_ip, "⬆",
+                                                  0 if self.is_folder else os.path.getsize(path)))
+            thread = threading.Thread(target=self._send_file_thread,
+                                      args=(recipient_ip, path, self.is_folder, transfer))
+            thread.daemon = True
+            thread.start()
+    
+    def send_to_many(self, recipients, is_link):
+        """Send the selected item to several devices at once"""
+        # Drop duplicates but keep the order, it decides who relays to whom
+        recipients = list(dict.fromkeys(recipients))
+        for recipient_ip in recipients:
+            self.add_device(recipient_ip)
+        
+        if is_link:
+            self.send_message(recipients, "link", self.current_link)
+            return
+        
+        path = self.selected_folder if self.is_folder else self.selected_file
+        name = os.path.basename(path)
+        fanout = FANOUT_MODES.get(self.fanout_mode.get())
+        plan = plan_relay(recipients, fanout)
+        transfers = [
+            self.add_transfer(Transfer(f"{name} (+{len(relay)} relayed)" if relay else name, peer_ip, "⬆"))
+            for peer_ip, relay in plan
+        ]
+        thread = threading.Thread(target=self._fanout_thread, args=(plan, fanout, path, self.is_folder, transfers))
         thread.daemon = True
         thread.start()
     
-    def _send_link_thread(self, recipient_ip, link_url):
-        """Send a link to recipient"""
+    def get_channel(self, peer_ip):
+        """Persistent message channel to a peer, opened on first use"""
+        channel = self.channels.get(peer_ip)
+        if channel is None or channel.closed:
+            channel = MessageChannel(peer_ip, on_ack=self._on_message_ack, on_error=self._on_message_error,
+                                     resolve=self.best_path)
+            self.channels[peer_ip] = channel
+        return channel
+    
+    def send_message(self, recipients, kind, data, warn=True):
+        """Send a link, text snippet or clipboard text to each recipient"""
+        unsupported = []
+        for recipient_ip in recipients:
+            if self.peer_version(recipient_ip) >= PROTOCOL_VERSION:
+                self.get_channel(recipient_ip).send(kind, data)
+            elif kind == "link":
+                # Older versions (or peers we haven't heard from yet) only take links one per connection
+                thread = threading.Thread(target=self._send_link_thread, args=(recipient_ip, data))
+                thread.daemon = True
+                thread.start()
+            else:
+                unsupported.append(recipient_ip)
+        
+        if unsupported:
+            self.set_status(f"✗ Can't send {kind} to {', '.join(unsupported)} yet", "#ef4444")
+            if warn:
+                self.post_ui(messagebox.showwarning, "Not Sent",
+                             f"{', '.join(unsupported)} hasn't shown it runs a version that takes {kind}.\n\n"
+                             "Send it a file or link first (or update NetTransfer there).")
+        if len(unsupported) < len(recipients):
+            self.set_status(f"Sending {kind}...", "#fbbf24")
+    
+    def _send_link_thread(self, recipient_ip, url):
+        """Send a link the way older versions expect it, a connection of its own"""
         try:
-            self.status_label.config(text="Connecting...", fg="#fbbf24")
-            
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(30)
-            sock.connect((recipient_ip, 5555))
-            
-            # Send link info
-            link_info = json.dumps({
-                "type": "link",
-                "url": link_url
-            })
-            sock.send(struct.pack("!I", len(link_info)))
-            sock.send(link_info.encode())
-            
-            # Wait for receiver response
-            self.status_label.config(text="Waiting for receiver...", fg="#fbbf24")
-            response = sock.recv(1024).decode()
-            
-            sock.close()
-            
-            if response == "ACCEPT":
-                self.status_label.config(text="✓ Link sent successfully!", fg="#4ade80")
-                messagebox.showinfo("Success", f"Link sent to {recipient_ip}")
+            with self.connect_peer(recipient_ip, timeout=self.approval_wait()) as sock:
+                send_json(sock, {"type": "link", "url": url, "version": PROTOCOL_VERSION,
+                                 "reply_timeout": self.approval_wait()})
+                accepted, _, version = parse_accept(sock.recv(1024).decode())
+            if accepted:
+                self.note_peer_version(recipient_ip, version)
+                self.set_status(f"✓ Link sent to {recipient_ip}", "#4ade80")
             else:
-                self.status_label.config(text="✗ Link declined by receiver", fg="#ef4444")
-            
+                self.set_status("✗ Link declined by receiver", "#ef4444")
         except Exception as e:
-            self.status_label.config(text="✗ Failed to send link", fg="#ef4444")
-            messagebox.showerror("Error", f"Failed to send link: {str(e)}")
+            self.set_status("✗ Failed to send link", "#ef4444")
+            self.post_ui(messagebox.showerror, "Error", f"Failed to send link: {str(e)}")
+    
+    def _on_message_ack(self, channel, message, latency, pending):
+        kind = message['kind'].title()
+        if pending:
+            self.set_status(f"{kind} reached {channel.peer_ip}, waiting for them to accept it", "#fbbf24")
+        else:
+            self.set_status(f"✓ {kind} delivered to {channel.peer_ip} ({latency * 1000:.1f} ms)", "#4ade80")
+    
+    def _on_message_error(self, channel, messages, error):
+        kinds = ", ".join(sorted({message["kind"] for message in messages}))
+        self.set_status(f"✗ Failed to send {kinds} to {channel.peer_ip}", "#ef4444")
+        self.post_ui(messagebox.showerror, "Error", f"Failed to send {kinds} to {channel.peer_ip}: {str(error)}")
+    
+    def acquire_send_slot(self, *transfers):
+        """Wait for a free send slot, giving up if the transfers get cancelled"""
+        while not self.send_slots.acquire(timeout=0.5):
+            if all(transfer.cancelled for transfer in transfers):
+                raise TransferCancelled()
+    
+    def send_stream(self, sock, f, size, transfer, extents=None):
+        """Send size bytes of f, updating the transfer's progress counter.
+        
+        With extents only those data regions of a sparse file are sent.
+        """
+        sent = 0
+        for data in read_extents(f, extents if extents is not None else [[f.tell(), size]]):
+            transfer.checkpoint()
+            sock.sendall(data)
+            sent += len(data)
+            transfer.bytes_done = sent
+        return sent
+    
+    def recv_stream(self, sock, f, size, transfer, forward=None, extents=None):
+        """Receive size bytes into f, updating the transfer's progress counter.
+        
+        With extents only the data regions of a sparse file arrive, they're written
+        at their offsets and the gaps are left as holes. Chunks are also handed to
+        the forward ChunkBuffer when relaying.
+        """
+        received = 0
+        for offset, length in extents if extents is not None else [[0, size]]:
+            if extents is not None:
+                f.seek(offset)
+            remaining = length
+            while remaining:
+                transfer.checkpoint()
+                data = sock.recv(min(CHUNK_SIZE, remaining))
+                if not data:
+                    raise ConnectionError("Connection closed before the transfer completed")
+                if forward is not None:
+                    forward.put(data)
+                f.write(data)
+                remaining -= len(data)
+                received += len(data)
+                transfer.bytes_done = received
+        if extents is not None:
+            # Extends the file with a hole if it ends in one (or is nothing but a hole)
+            f.truncate(size)
+        return received
     
-    def _send_file_thread(self, recipient_ip):
+    def _send_file_thread(self, recipient_ip, path, is_folder, transfer):
         temp_zip_path = None
+        sock = None
+        slot_acquired = False
         try:
-            self.status_label.config(text="Connecting...", fg="#fbbf24")
+            self.acquire_send_slot(transfer)
+            slot_acquired = True
+            transfer.state = "Connecting"
+            self.set_status("Connecting...", "#fbbf24")
             
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(30)
-            sock.connect((recipient_ip, 5555))
+            sock = self.connect_peer(recipient_ip)
             
             # Prepare file info
-            if self.is_folder:
+            if is_folder:
                 # Zip the folder
-                self.status_label.config(text="Zipping folder...", fg="#fbbf24")
-                temp_zip_path = self.zip_folder(self.selected_folder)
+                transfer.state = "Zipping"
+                self.set_status("Zipping folder...", "#fbbf24")
+                temp_zip_path = self.zip_folder(path, lambda: transfer.cancelled)
                 file_to_send = temp_zip_path
-                original_name = os.path.basename(self.selected_folder)
+                original_name = os.path.basename(path)
                 filename = f"{original_name}.zip"
-                is_folder = True
             else:
-                file_to_send = self.selected_file
-                filename = os.path.basename(self.selected_file)
-                is_folder = False
+                file_to_send = path
+                filename = os.path.basename(path)
             
+            if transfer.cancelled:
+                raise TransferCancelled()
             filesize = os.path.getsize(file_to_send)
+            extents = None if is_folder else data_extents(file_to_send, filesize)
+            transfer.total = filesize
             
-            file_info = json.dumps({
+            file_info = {
                 "type": "file",
                 "filename": filename,
                 "filesize": filesize,
                 "is_folder": is_folder,
-                "original_name": original_name if is_folder else None
-            })
-            sock.send(struct.pack("!I", len(file_info)))
-            sock.send(file_info.encode())
+                "original_name": original_name if is_folder else None,
+                "version": PROTOCOL_VERSION,
+                "reply_timeout": self.approval_wait()
+            }
+            if extents is not None:
+                # Only the data regions go over the wire, the receiver recreates the holes
+                file_info["sparse"] = extents
+                file_info["data_size"] = sum(length for _, length in extents)
+            send_json(sock, file_info)
             
             # Wait for receiver acceptance
-            self.status_label.config(text="Waiting for receiver...", fg="#fbbf24")
-            response = sock.recv(1024).decode()
+            transfer.state = "Waiting"
+            self.set_status("Waiting for receiver...", "#fbbf24")
+            accepted, sparse, version = parse_accept(recv_reply(sock, transfer, file_info["reply_timeout"]))
             
-            if response != "ACCEPT":
-                sock.close()
-                if temp_zip_path and os.path.exists(temp_zip_path):
-                    os.unlink(temp_zip_path)
-                self.status_label.config(text="Transfer declined by receiver", fg="#888888")
+            if not accepted:
+                transfer.state = "Declined"
+                self.set_status("Transfer declined by receiver", "#888888")
                 return
+            self.note_peer_version(recipient_ip, version)
+            if sparse:
+                transfer.total = file_info["data_size"]
+            else:
+                # Older receivers don't know about holes, send everything
+                extents = None
+            
+            # A paused transfer may sit idle for a while, rely on keepalive instead of a timeout
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            sock.settimeout(None)
             
             # Send file data
             display_name = f"folder '{original_name}'" if is_folder else f"file '{filename}'"
-            self.status_label.config(text=f"Sending {display_name}...", fg="#fbbf24")
+            transfer.state = "Sending"
+            self.set_status(f"Sending {display_name}...", "#fbbf24")
             with open(file_to_send, 'rb') as f:
-                sent = 0
-                while sent < filesize:
-                    data = f.read(4096)
-                    if not data:
-                        break
-                    sock.send(data)
-                    sent += len(data)
+                self.send_stream(sock, f, filesize, transfer, extents)
             
             # Wait for completion confirmation
-            self.status_label.config(text="Waiting for confirmation...", fg="#fbbf24")
+            transfer.state = "Confirming"
+            self.set_status("Waiting for confirmation...", "#fbbf24")
             confirmation = sock.recv(1024).decode()
             
-            sock.close()
+            if confirmation == "SUCCESS":
+                transfer.state = "Done"
+                self.set_status("✓ Transfer successful!", "#4ade80")
+                self.post_ui(messagebox.showinfo, "Success", f"{'Folder' if is_folder else 'File'} sent to {recipient_ip}")
+            else:
+                transfer.state = "Failed"
+                self.set_status("✗ Transfer failed on receiver", "#ef4444")
+            
+        except TransferCancelled:
+            transfer.state = "Cancelled"
+            self.set_status("Transfer cancelled", "#888888")
+            
+        except Exception as e:
+            transfer.state = "Failed"
+            self.set_status("✗ Transfer failed", "#ef4444")
+            self.post_ui(messagebox.showerror, "Error", f"Failed to send: {str(e)}")
             
+        finally:
+            if sock:
+                sock.close()
+            if slot_acquired:
+                self.send_slots.release()
             # Clean up temp zip
             if temp_zip_path and os.path.exists(temp_zip_path):
                 os.unlink(temp_zip_path)
+    
+    def start_fanout(self, item_info, plan, transfers):
+        """Start streaming an item to every (device, relay list) in plan.
+        
+        Returns (buffer, threads, results): the caller feeds the item into the
+        buffer once and every device reads from it concurrently.
+        """
+        buffer = ChunkBuffer()
+        results = {}
+        threads = []
+        for (peer_ip, relay), transfer in zip(plan, transfers):
+            consumer = buffer.add_consumer()
+            thread = threading.Thread(target=self._relay_to_peer,
+                                      args=(peer_ip, item_info, relay, buffer, consumer, transfer, results))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        return buffer, threads, results
+    
+    def collect_fanout(self, plan, threads, results):
+        """Wait for a fan-out to finish, returns the devices that didn't get the item"""
+        for thread in threads:
+            thread.join()
+        
+        failed = []
+        for peer_ip, relay in plan:
+            result = results.get(peer_ip, "FAIL")
+            if result == "SUCCESS":
+                continue
+            if result.startswith("RELAY_FAIL "):
+                failed.extend(ip for ip in result[len("RELAY_FAIL "):].split(",") if ip)
+            else:
+                # The device never got it, so neither did anyone it relays to
+                failed.append(peer_ip)
+                failed.extend(relay)
+        return failed
+    
+    def _relay_to_peer(self, peer_ip, item_info, relay, buffer, consumer, transfer, results):
+        """Stream an item from a shared buffer to one device"""
+        sock = None
+        results[peer_ip] = "FAIL"
+        try:
+            transfer.state = "Connecting"
+            sock = self.connect_peer(peer_ip)
+            send_json(sock, dict(item_info, relay=relay, reply_timeout=self.approval_wait()))
             
-            if confirmation == "SUCCESS":
-                self.status_label.config(text="✓ Transfer successful!", fg="#4ade80")
-                messagebox.showinfo("Success", f"{'Folder' if is_folder else 'File'} sent to {recipient_ip}")
+            transfer.state = "Waiting"
+            accepted, sparse, version = parse_accept(recv_reply(sock, transfer, self.approval_wait()))
+            if not accepted:
+                transfer.state = "Declined"
+                results[peer_ip] = "DECLINE"
+                return
+            self.note_peer_version(peer_ip, version)
+            
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            sock.settimeout(None)
+            
+            chunks = iter(lambda: buffer.get(consumer), None)
+            if item_info.get("sparse") is not None and not sparse:
+                # The buffer only holds the data regions, fill the holes back in for an older receiver
+                chunks = expand_sparse(chunks, item_info["sparse"], item_info["filesize"])
+                transfer.total = item_info["filesize"]
+            
+            transfer.state = "Sending"
+            sent = 0
+            for chunk in chunks:
+                transfer.checkpoint()
+                sock.sendall(chunk)
+                sent += len(chunk)
+                transfer.bytes_done = sent
+            
+            transfer.state = "Confirming"
+            results[peer_ip] = sock.recv(1024).decode() or "FAIL"
+            transfer.state = "Done" if results[peer_ip] != "FAIL" else "Failed"
+            if relay and version < PROTOCOL_VERSION and results[peer_ip] == "SUCCESS":
+                # An older receiver ignores the relay list, nobody got it from there
+                results[peer_ip] = f"RELAY_FAIL {','.join(relay)}"
+            
+        except TransferCancelled:
+            transfer.state = "Cancelled"
+        except Exception as e:
+            transfer.state = "Failed"
+            print(f"Error sending to {peer_ip}: {e}")
+        finally:
+            # Don't hold back the other devices
+            buffer.remove_consumer(consumer)
+            if sock:
+                sock.close()
+    
+    def _fanout_thread(self, plan, fanout, path, is_folder, transfers):
+        """Send one file or folder to several devices, reading and zipping it only once"""
+        temp_zip_path = None
+        buffer = None
+        slot_acquired = False
+        try:
+            self.acquire_send_slot(*transfers)
+            slot_acquired = True
+            
+            if is_folder:
+                self.set_status("Zipping folder...", "#fbbf24")
+                temp_zip_path = self.zip_folder(path, lambda: all(t.cancelled for t in transfers))
+                file_to_send = temp_zip_path
+                original_name = os.path.basename(path)
+                filename = f"{original_name}.zip"
+            else:
+                file_to_send = path
+                filename = os.path.basename(path)
+            
+            if all(transfer.cancelled for transfer in transfers):
+                raise TransferCancelled()
+            filesize = os.path.getsize(file_to_send)
+            extents = None if is_folder else data_extents(file_to_send, filesize)
+            
+            item_info = {
+                "type": "file",
+                "filename": filename,
+                "filesize": filesize,
+                "is_folder": is_folder,
+                "original_name": original_name if is_folder else None,
+                "relay_fanout": fanout,
+                "version": PROTOCOL_VERSION
+            }
+            if extents is not None:
+                item_info["sparse"] = extents
+                item_info["data_size"] = sum(length for _, length in extents)
+            for transfer in transfers:
+                transfer.total = item_info.get("data_size", filesize)
+            target_count = sum(1 + len(relay) for _, relay in plan)
+            self.set_status(f"Sending to {target_count} devices...", "#fbbf24")
+            
+            buffer, threads, results = self.start_fanout(item_info, plan, transfers)
+            with open(file_to_send, 'rb') as f:
+                for data in read_extents(f, extents if extents is not None else [[0, filesize]]):
+                    # Stop reading once every device declined or failed
+                    if not buffer.put(data):
+                        break
+            buffer.close()
+            
+            failed = self.collect_fanout(plan, threads, results)
+            if not failed:
+                self.set_status(f"✓ Sent to all {target_count} devices!", "#4ade80")
+                self.post_ui(messagebox.showinfo, "Success", f"{'Folder' if is_folder else 'File'} sent to {target_count} devices")
             else:
-                self.status_label.config(text="✗ Transfer failed on receiver", fg="#ef4444")
+                self.set_status(f"✗ {len(failed)} of {target_count} devices didn't receive it", "#ef4444")
+                self.post_ui(messagebox.showwarning, "Partly Sent",
+                             f"Sent to {target_count - len(failed)} of {target_count} devices.\n\nFailed: {', '.join(failed)}")
+            
+        except TransferCancelled:
+            for transfer in transfers:
+                transfer.state = "Cancelled"
+            self.set_status("Transfer cancelled", "#888888")
             
         except Exception as e:
-            # Clean up temp zip on error
+            if buffer:
+                buffer.abort()
+            for transfer in transfers:
+                if not transfer.finished:
+                    transfer.state = "Failed"
+            self.set_status("✗ Transfer failed", "#ef4444")
+            self.post_ui(messagebox.showerror, "Error", f"Failed to send: {str(e)}")
+            
+        finally:
+            if slot_acquired:
+                self.send_slots.release()
             if temp_zip_path and os.path.exists(temp_zip_path):
                 os.unlink(temp_zip_path)
-            
-            self.status_label.config(text="✗ Transfer failed", fg="#ef4444")
-            messagebox.showerror("Error", f"Failed to send: {str(e)}")
+    
+    def best_path(self, peer_ip):
+        """Address to reach peer_ip on, probing all its interfaces once per path_cache_ttl"""
+        if not self.settings.get("best_path_probe", True) or self.peer_version(peer_ip) < PROTOCOL_VERSION:
+            return peer_ip
+        with self.path_lock:
+            cached = self.path_cache.get(peer_ip)
+            if cached and cached[1] > time.monotonic():
+                return cached[0]
+            if peer_ip in self.path_probes:
+                # Another send is measuring this peer, don't wait on it
+                return peer_ip
+            self.path_probes.add(peer_ip)
+        
+        try:
+            address = self.probe_paths(peer_ip)
+        finally:
+            with self.path_lock:
+                self.path_probes.discard(peer_ip)
+        with self.path_lock:
+            self.path_cache[peer_ip] = (address, time.monotonic() + self.settings.get("path_cache_ttl", 600))
+        return address
+    
+    def probe_paths(self, peer_ip):
+        """Measure RTT and throughput to every address the peer has, returns the fastest"""
+        challenge = new_challenge()
+        try:
+            with socket.create_connection((peer_ip, 5555), timeout=PROBE_TIMEOUT) as sock:
+                # The peer echoes our challenge on its other addresses, and our addresses let it
+                # recognise us over another interface once it has checked them the same way
+                send_json(sock, {"type": "probe", "version": PROTOCOL_VERSION, "challenge": challenge,
+                                 "addresses": self.local_addresses})
+                response = recv_json(sock)
+                addresses = response.get("addresses")
+                if not isinstance(addresses, list):
+                    return peer_ip
+                # Stored before hanging up, the peer starts checking our addresses then
+                self.remember_challenge(response.get("challenge"), [peer_ip] + addresses)
+        except (OSError, ValueError):
+            # Offline, or the peer went back to an older version
+            return peer_ip
+        
+        # Addresses we have ourselves (docker, libvirt, VPN bridges...) would just route back to us
+        candidates = [peer_ip] + [address for address in addresses
+                                  if isinstance(address, str) and address != peer_ip
+                                  and address not in self.local_addresses]
+        if len(candidates) == 1:
+            return peer_ip
+        
+        results = []
+        for address in candidates:
+            try:
+                rtt, throughput, secret = measure_path(address, challenge["id"])
+            except (OSError, ValueError):
+                continue
+            if secret != challenge["secret"]:
+                # Some other machine has this address on our side of the network
+                continue
+            results.append((throughput, -rtt, address))
+        return max(results)[2] if results else peer_ip
+    
+    def connect_peer(self, peer_ip, timeout=30):
+        """Connect to a peer over its fastest known path"""
+        address = self.best_path(peer_ip)
+        try:
+            return socket.create_connection((address, 5555), timeout=timeout)
+        except OSError:
+            if address == peer_ip:
+                raise
+            # The cached path went away, probe again next time
+            self.path_cache.pop(peer_ip, None)
+            return socket.create_connection((peer_ip, 5555), timeout=timeout)
+    
+    def _serve_probe(self, client, addr, request):
+        """Tell a peer our addresses and answer its RTT and throughput measurements.
+        
+        A trusted device listing its other addresses gets a challenge back, and once it
+        hangs up each address is checked by asking it for the secret.
+        """
+        addresses = request.get("addresses")
+        claimed = self.claimed_device_addresses(addr[0], addresses)
+        challenge = new_challenge() if claimed else None
+        self.remember_challenge(request.get("challenge"), [addr[0]] + (addresses if isinstance(addresses, list) else []))
+        try:
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            send_json(client, {"status": "OK", "addresses": self.local_addresses, "challenge": challenge,
+                               "secret": self.challenge_secret(request.get("challenge_id"), addr[0])})
+            zeros = bytes(CHUNK_SIZE)
+            while True:
+                request = recv_json(client)
+                if request.get("op") == "ping":
+                    send_json(client, {"op": "pong"})
+                elif request.get("op") == "data":
+                    remaining = max(0, min(int(request.get("size", 0)), PROBE_BYTES))
+                    while remaining:
+                        remaining -= client.send(zeros[:min(CHUNK_SIZE, remaining)])
+                else:
+                    break
+        except (ConnectionError, OSError, ValueError):
+            pass
+        finally:
+            client.close()
+        
+        if claimed:
+            self.learn_device_addresses(addr[0], claimed, challenge)
     
     def start_server(self):
         self.server_running = True
@@ -691,10 +2584,12 @@ class FileTransferApp:
         self.server_thread.start()
     
     def _server_thread(self):
-        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server.bind(('0.0.0.0', 5555))
-        server.listen(5)
+        try:
+            server = create_listener(5555)
+        except OSError as e:
+            self.set_status(f"✗ Can't listen on port 5555: {e}", "#ef4444")
+            return
+        self.server_ready.set()
         
         while self.server_running:
             try:
@@ -708,139 +2603,711 @@ class FileTransferApp:
             except:
                 break
     
+    def get_save_dir(self):
+        """Directory used for items that are saved without a dialog"""
+        save_dir = self.settings.get("default_save_dir")
+        if save_dir and os.path.isdir(save_dir):
+            return save_dir
+        downloads = os.path.join(os.path.expanduser("~"), "Downloads")
+        return downloads if os.path.isdir(downloads) else os.path.expanduser("~")
+    
+    def reserve_path(self, directory, filename, is_dir=False):
+        """Create an empty file (or directory) for filename in directory without
+        overwriting anything, returns its path.
+        
+        Creating it claims the name, so two items with the same name arriving at
+        once can't end up writing the same file.
+        """
+        base, ext = (filename, "") if is_dir else os.path.splitext(filename)
+        path = os.path.join(directory, filename)
+        counter = 1
+        while True:
+            try:
+                if is_dir:
+                    os.mkdir(path)
+                else:
+                    os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return path
+            except FileExistsError:
+                path = os.path.join(directory, f"{base} ({counter}){ext}")
+                counter += 1
+    
+    def should_auto_accept(self, addr, item_info):
+        """Check the auto-accept rules for an incoming item"""
+        if not self.settings.get("auto_accept_trusted") or not self.is_trusted(addr[0]):
+            return False
+        if item_info.get("type") in MESSAGE_KINDS:
+            return True
+        max_size = self.settings.get("auto_accept_max_size", 0)
+        return not max_size or item_info["filesize"] <= max_size
+    
+    def default_target(self, item_info):
+        """Save location used when no dialog is shown"""
+        if item_info.get("type") == "messages":
+            return item_info["messages"]
+        if item_info.get("type") == "link":
+            return item_info["url"]
+        if item_info.get("type") in MESSAGE_KINDS:
+            return item_info["text"]
+        if item_info.get("is_folder"):
+            return self.get_save_dir()
+        return self.reserve_path(self.get_save_dir(), os.path.basename(item_info["filename"]))
+    
+    def ask_target(self, item_info):
+        """Ask where to save an accepted item, None if the user cancelled"""
+        from tkinter import filedialog
+        if (item_info.get("type") in MESSAGE_KINDS or item_info.get("type") == "messages"
+                or self.settings.get("default_save_dir")):
+            return self.default_target(item_info)
+        if item_info.get("is_folder"):
+            return filedialog.askdirectory(title="Select where to extract folder") or None
+        return filedialog.asksaveasfilename(
+            defaultextension="",
+            initialfile=os.path.basename(item_info["filename"]),
+            title="Save file as"
+        ) or None
+    
+    def approval_wait(self):
+        """Seconds a decision may take: the prompt's timeout plus time to pick a save location.
+        
+        Receivers wait at most this long, and so do senders for their ACCEPT.
+        """
+        return self.settings.get("approval_timeout", 30) + APPROVAL_GRACE
+    
+    def request_approval(self, addr, item_info):
+        """Get a decision for an incoming item without touching Tk from this thread"""
+        # Answer before the sender gives up, or it reports a failure for an item we accepted
+        reply_timeout = item_info.get("reply_timeout", LEGACY_REPLY_TIMEOUT)
+        if not isinstance(reply_timeout, (int, float)):
+            reply_timeout = LEGACY_REPLY_TIMEOUT
+        request = ApprovalRequest(addr, item_info, min(self.approval_wait(), max(reply_timeout - REPLY_MARGIN, 1)))
+        if self.should_auto_accept(addr, item_info):
+            request.resolve(True, self.default_target(item_info))
+        else:
+            self.post_ui(self.show_approval, request)
+        request.wait(request.timeout)
+        return request
+    
+    def show_approval(self, request):
+        """Non-modal prompt for an incoming item, declines itself after a timeout"""
+        try:
+            self._create_approval_prompt(request)
+        except:
+            # A header the prompt can't show (e.g. no filesize) must not leave the sender hanging
+            request.resolve(False)
+            raise
+    
+    def approval_message(self, request):
+        """Title and text of the approval prompt for a request"""
+        item_info = request.item_info
+        peer_ip = request.addr[0]
+        
+        if item_info.get("type") == "messages":
+            messages = list(item_info["messages"])
+            title = "Incoming Messages"
+            lines = []
+            for item in messages[:10]:
+                text = item.get("url") or item.get("text")
+                preview = text if len(text) <= 80 else text[:77] + "..."
+                lines.append(f"{item['type'].title()}: {preview}")
+            if len(messages) > 10:
+                lines.append(f"...and {len(messages) - 10} more")
+            message = f"Receive {len(messages)} message(s) from {peer_ip}?\n\n" + "\n".join(lines)
+        elif item_info.get("type") == "link":
+            title = "Incoming Link"
+            message = f"Open link from {peer_ip}?\n\nURL: {item_info['url']}\n\nLink will open in new tab"
+        elif item_info.get("type") in MESSAGE_KINDS:
+            text = item_info["text"]
+            preview = text if len(text) <= 300 else text[:297] + "..."
+            if item_info["type"] == "clipboard":
+                title = "Incoming Clipboard"
+                message = f"Replace your clipboard with text from {peer_ip}?\n\n{preview}"
+            else:
+                title = "Incoming Text"
+                message = f"Receive text from {peer_ip}?\n\n{preview}"
+        else:
+            item_type_str = "folder" if item_info.get("is_folder") else "file"
+            display_name = item_info.get("original_name") if item_info.get("is_folder") else item_info["filename"]
+            title = f"Incoming {item_type_str.title()}"
+            message = (f"Receive {item_type_str} from {peer_ip}?\n\n"
+                       f"{item_type_str.title()}: {display_name}\nSize: {item_info['filesize'] / 1024:.2f} KB")
+            relay = self.relay_targets(item_info)
+            if relay:
+                # Accepting also means uploading to these, so they have to be visible
+                message += f"\n\nYou will also forward it to: {', '.join(relay)}"
+        return title, message
+    
+    def _create_approval_prompt(self, request):
+        item_info = request.item_info
+        peer_ip = request.addr[0]
+        title, message = self.approval_message(request)
+        
+        prompt = tk.Toplevel(self.root)
+        prompt.title(title)
+        prompt.configure(bg="#2b2b2b")
+        prompt.attributes("-topmost", True)
+        
+        label = tk.Label(
+            prompt,
+            text=message,
+            bg="#2b2b2b",
+            fg="white",
+            font=("Arial", 10),
+            justify=tk.LEFT,
+            wraplength=400
+        )
+        label.pack(padx=20, pady=15)
+        
+        if item_info.get("type") == "messages":
+            # More messages from the same peer join this prompt while it's open
+            def refresh():
+                if prompt.winfo_exists():
+                    label.config(text=self.approval_message(request)[1])
+                    prompt.after(500, refresh)
+            prompt.after(500, refresh)
+        
+        trust_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(
+            prompt,
+            text=f"Always accept from {peer_ip}",
+            variable=trust_var,
+            bg="#2b2b2b",
+            fg="white",
+            selectcolor="#3c3c3c",
+            activebackground="#2b2b2b",
+            activeforeground="white",
+            font=("Arial", 9)
+        ).pack(padx=20, anchor=tk.W)
+        
+        def accept():
+            prompt.destroy()
+            if trust_var.get():
+                self.set_device_trusted(peer_ip)
+            target = self.ask_target(item_info)
+            if not request.resolve(target is not None, target):
+                # Answered after the sender stopped waiting
+                self.set_status(f"✗ Too late, {peer_ip} stopped waiting", "#ef4444")
+                if (target and not item_info.get("is_folder") and item_info.get("type") not in MESSAGE_KINDS
+                        and os.path.isfile(target) and not os.path.getsize(target)):
+                    # Empty file reserved for it by default_target
+                    os.unlink(target)
+        
+        def decline():
+            if prompt.winfo_exists():
+                prompt.destroy()
+            request.resolve(False)
+        
+        button_frame = tk.Frame(prompt, bg="#2b2b2b")
+        button_frame.pack(pady=15)
+        
+        tk.Button(
+            button_frame,
+            text="Accept",
+            command=accept,
+            bg="#4ade80",
+            fg="white",
+            font=("Arial", 10, "bold"),
+            padx=20,
+            pady=5,
+            relief=tk.FLAT,
+            cursor="hand2"
+        ).pack(side=tk.LEFT, padx=5)
+        
+        tk.Button(
+            button_frame,
+            text="Decline",
+            command=decline,
+            bg="#666666",
+            fg="white",
+            font=("Arial", 10),
+            padx=20,
+            pady=5,
+            relief=tk.FLAT,
+            cursor="hand2"
+        ).pack(side=tk.LEFT, padx=5)
+        
+        prompt.protocol("WM_DELETE_WINDOW", decline)
+        timeout = self.settings.get("approval_timeout", 30)
+        if request.timeout is not None:
+            timeout = min(timeout, request.timeout)
+        prompt.after(int(timeout * 1000), decline)
+    
+    def deliver_messages(self, addr, messages):
+        """Handle one frame from a MessageChannel (runs on the channel's socket thread).
+        
+        Returns the ids of messages left waiting for approval.
+        """
+        waiting = []
+        for message in messages:
+            kind = message.get("kind")
+            data = message.get("data")
+            if kind not in MESSAGE_KINDS or not isinstance(data, str):
+                continue
+            if kind == "link":
+                if not self.is_valid_url(data):
+                    continue
+                item_info = {"type": kind, "url": data}
+            else:
+                item_info = {"type": kind, "text": data}
+            
+            if self.should_auto_accept(addr, item_info):
+                # Trusted peers skip the prompt entirely
+                self.post_ui(self.show_message, addr[0], item_info)
+            else:
+                waiting.append((message.get("id"), item_info))
+        
+        if not waiting:
+            return []
+        
+        # One prompt per peer: messages arriving while it's open are added to it
+        with self.pending_lock:
+            request = self.pending_messages.get(addr[0])
+            is_new = request is None or request.decided
+            if is_new:
+                request = ApprovalRequest(addr, {"type": "messages", "messages": []})
+                self.pending_messages[addr[0]] = request
+            request.item_info["messages"].extend(item_info for _, item_info in waiting)
+        
+        if is_new:
+            # Ack right away, the prompt must not hold up the rest of the channel
+            self.post_ui(self.show_approval, request)
+            thread = threading.Thread(target=self._deliver_after_approval, args=(request,))
+            thread.daemon = True
+            thread.start()
+        return [message_id for message_id, _ in waiting]
+    
+    def _deliver_after_approval(self, request):
+        accepted = request.wait(self.approval_wait())
+        with self.pending_lock:
+            if self.pending_messages.get(request.addr[0]) is request:
+                del self.pending_messages[request.addr[0]]
+        if accepted:
+            for item_info in request.item_info["messages"]:
+                self.post_ui(self.show_message, request.addr[0], item_info)
+    
+    def show_message(self, peer_ip, item_info):
+        """Act on an accepted link, text snippet or clipboard text"""
+        kind = item_info["type"]
+        if kind == "link":
+            self.open_link(item_info["url"])
+        elif kind == "clipboard":
+            # Remember it so the clipboard sync doesn't send it straight back
+            self.last_clipboard = item_info["text"]
+            self.root.clipboard_clear()
+            self.root.clipboard_append(item_info["text"])
+            self.set_status(f"📋 Clipboard updated from {peer_ip}", "#4ade80")
+        else:
+            self.show_text(peer_ip, item_info["text"])
+    
+    def show_text(self, peer_ip, text):
+        """Non-modal window showing a received text snippet"""
+        window = tk.Toplevel(self.root)
+        window.title(f"Text from {peer_ip}")
+        window.geometry("450x250")
+        window.configure(bg="#2b2b2b")
+        
+        text_box = tk.Text(window, bg="#3c3c3c", fg="white", insertbackground="white", font=("Arial", 10), wrap=tk.WORD)
+        text_box.insert("1.0", text)
+        text_box.pack(padx=10, pady=10, fill=tk.BOTH, expand=True)
+        
+        def copy():
+            self.last_clipboard = text
+            self.root.clipboard_clear()
+            self.root.clipboard_append(text)
+            window.destroy()
+        
+        tk.Button(
+            window,
+            text="📋 Copy & Close",
+            command=copy,
+            bg="#4a90e2",
+            fg="white",
+            font=("Arial", 10),
+            padx=15,
+            pady=5,
+            relief=tk.FLAT,
+            cursor="hand2"
+        ).pack(pady=(0, 10))
+    
+    def _poll_clipboard(self):
+        """Push local clipboard changes to the peers in clipboard_sync_peers"""
+        self.root.after(CLIPBOARD_POLL_MS, self._poll_clipboard)
+        peers = self.settings.get("clipboard_sync_peers") or []
+        if not peers:
+            return
+        try:
+            text = self.root.clipboard_get()
+        except tk.TclError:
+            return
+        if text == self.last_clipboard:
+            return
+        first_poll = self.last_clipboard is None
+        self.last_clipboard = text
+        if not first_poll:
+            self.send_message(peers, "clipboard", text, warn=False)
+    
+    def open_link(self, url):
+        """Open a received link (runs on the UI thread)"""
+        import webbrowser
+        if self.settings["open_links_incognito"]:
+            # Show incognito instructions
+            msg = (f"Opening link in new tab:\n{url}\n\n"
+                   "🔒 For security, open in incognito/private mode:\n"
+                   "• Chrome/Edge: Right-click tab → 'Reopen in Incognito'\n"
+                   "• Firefox: Right-click tab → 'Reopen in Private Window'\n"
+                   "• Safari: File → New Private Window, paste URL")
+            messagebox.showinfo("Link Received", msg)
+        
+        webbrowser.open_new_tab(url)
+    
     def _handle_client(self, client, addr):
+        transfer = None
+        # Same form for IPv4 peers whether they came in over IPv4 or dual-stack IPv6
+        addr = (normalize_ip(addr[0]), addr[1])
         try:
             # Receive item info
-            info_size = struct.unpack("!I", client.recv(4))[0]
-            item_info = json.loads(client.recv(info_size).decode())
+            item_info = recv_json(client)
+            # No version field means an older version that only knows files and links
+            self.note_peer_version(addr[0], item_info.get("version", 1))
             
             item_type = item_info.get("type", "file")
+            if item_type in ("list_shares", "list", "fetch"):
+                # Pull requests are served straight from the share index
+                self._serve_share_request(client, addr, item_info)
+                return
+            if item_type == "probe":
+                self._serve_probe(client, addr, item_info)
+                return
+            if item_type == "channel":
+                serve_channel(client, lambda messages: self.deliver_messages(addr, messages))
+                client.close()
+                return
+            
+            request = self.request_approval(addr, item_info)
+            
+            if not request.accepted:
+                client.send("DECLINE".encode())
+                client.close()
+                return
+            
+            # Send acceptance, a sparse sender then only sends the data regions
+            sparse = item_type == "file" and not item_info.get("is_folder") and item_info.get("sparse") is not None
+            reply = "ACCEPT SPARSE" if sparse else "ACCEPT"
+            if "version" in item_info:
+                # Lets the sender know it can use probes and message channels with us
+                reply += f" V{PROTOCOL_VERSION}"
+            client.send(reply.encode())
             
             if item_type == "link":
-                # Handle link
-                url = item_info["url"]
-                
-                # Show popup
-                result = messagebox.askyesno(
-                    "Incoming Link",
-                    f"Open link from {addr[0]}?\n\nURL: {url}\n\nLink will open in new tab"
-                )
-                
-                if not result:
-                    client.send("DECLINE".encode())
-                    client.close()
-                    return
-                
-                # Send acceptance
-                client.send("ACCEPT".encode())
                 client.close()
-                
-                # Open link
-                if self.settings["open_links_incognito"]:
-                    # Show incognito instructions
-                    msg = (f"Opening link in new tab:\n{url}\n\n"
-                           "🔒 For security, open in incognito/private mode:\n"
-                           "• Chrome/Edge: Right-click tab → 'Reopen in Incognito'\n"
-                           "• Firefox: Right-click tab → 'Reopen in Private Window'\n"
-                           "• Safari: File → New Private Window, paste URL")
-                    messagebox.showinfo("Link Received", msg)
-                
-                webbrowser.open_new_tab(url)
+                self.post_ui(self.open_link, item_info["url"])
                 
             else:
-                # Handle file transfer (existing code)
-                filename = item_info["filename"]
-                filesize = item_info["filesize"]
                 is_folder = item_info.get("is_folder", False)
-                original_name = item_info.get("original_name", None)
-                
-                # Show popup
-                item_type_str = "folder" if is_folder else "file"
-                display_name = original_name if is_folder else filename
-                result = messagebox.askyesno(
-                    f"Incoming {item_type_str.title()}",
-                    f"Receive {item_type_str} from {addr[0]}?\n\n{item_type_str.title()}: {display_name}\nSize: {filesize / 1024:.2f} KB"
-                )
-                
-                if not result:
-                    client.send("DECLINE".encode())
-                    client.close()
-                    return
+                display_name = item_info.get("original_name") if is_folder else item_info["filename"]
+                transfer = self.add_transfer(Transfer(display_name, addr[0], "⬇",
+                                                      item_info.get("data_size", item_info["filesize"])))
+                self._receive_file(client, addr, item_info, request.target, transfer)
+                client.close()
+            
+        except TransferCancelled:
+            if transfer:
+                transfer.state = "Cancelled"
+            self.set_status("Transfer cancelled", "#888888")
+            try:
+                client.send("FAIL".encode())
+            except:
+                pass
+            client.close()
+            
+        except Exception as e:
+            if transfer:
+                transfer.state = "Failed"
+            try:
+                client.send("FAIL".encode())
+            except:
+                pass
+            self.post_ui(messagebox.showerror, "Error", f"Failed to receive: {str(e)}")
+            client.close()
+    
+    def relay_targets(self, item_info):
+        """Devices the sender asks us to forward an item to, empty if relaying is off"""
+        relay = item_info.get("relay") or []
+        if not self.settings.get("allow_relay", True) or not isinstance(relay, list):
+            return []
+        return [ip for ip in relay if isinstance(ip, str)]
+    
+    def _start_relay(self, item_info, display_name):
+        """Start forwarding an item we receive to the devices the sender asked us to relay to.
+        
+        Only runs for accepted items: either the sender is trusted, or the user saw
+        the relay targets in the approval prompt.
+        """
+        relay = self.relay_targets(item_info)
+        if not relay:
+            return None
+        
+        plan = plan_relay(relay, item_info.get("relay_fanout"))
+        size = item_info.get("data_size", item_info["filesize"])
+        transfers = [self.add_transfer(Transfer(f"{display_name} (relay)", peer_ip, "⬆", size))
+                     for peer_ip, _ in plan]
+        buffer, threads, results = self.start_fanout(item_info, plan, transfers)
+        return buffer, plan, threads, results
+    
+    def _finish_relay(self, item_info, relay_state):
+        """Wait for forwarding to finish, returns the confirmation for our sender"""
+        if relay_state is None:
+            # Asked to relay but relaying is turned off
+            failed = item_info.get("relay") or []
+        else:
+            buffer, plan, threads, results = relay_state
+            buffer.close()
+            failed = self.collect_fanout(plan, threads, results)
+        return f"RELAY_FAIL {','.join(failed)}" if failed else "SUCCESS"
+    
+    def _receive_file(self, client, addr, item_info, target, transfer):
+        """Receive an accepted file or zipped folder into target, forwarding it if asked to relay"""
+        import shutil
+        import tempfile
+        import zipfile
+        filesize = item_info["filesize"]
+        is_folder = item_info.get("is_folder", False)
+        original_name = item_info.get("original_name", None)
+        extents = item_info.get("sparse") if not is_folder else None
+        transfer.state = "Receiving"
+        
+        relay_state = None
+        forward = None
+        final_path = None
+        try:
+            if extents is not None:
+                item_info["data_size"] = validate_extents(extents, filesize)
+            relay_state = self._start_relay(item_info, transfer.name)
+            forward = relay_state[0] if relay_state else None
+            
+            if is_folder:
+                # Never merge into (or overwrite) a folder that's already there
+                folder_name = os.path.basename(original_name or "") or "folder"
+                final_path = self.reserve_path(target, folder_name, is_dir=True)
                 
-                # Send acceptance
-                client.send("ACCEPT".encode())
+                # Receive zip file to temp location
+                temp_zip = tempfile.NamedTemporaryFile(delete=False, suffix='.zip')
+                temp_zip.close()
                 
-                if is_folder:
-                    # Ask where to extract the folder
-                    extract_dir = filedialog.askdirectory(title="Select where to extract folder")
-                    if not extract_dir:
-                        client.send("FAIL".encode())
-                        client.close()
-                        return
-                    
-                    # Receive zip file to temp location
-                    temp_zip = tempfile.NamedTemporaryFile(delete=False, suffix='.zip')
-                    temp_zip.close()
-                    
+                try:
                     with open(temp_zip.name, 'wb') as f:
-                        received = 0
-                        while received < filesize:
-                            data = client.recv(min(4096, filesize - received))
-                            if not data:
-                                break
-                            f.write(data)
-                            received += len(data)
+                        self.recv_stream(client, f, filesize, transfer, forward)
+                    if forward:
+                        forward.close()
                     
-                    # Extract the zip file
-                    try:
-                        with zipfile.ZipFile(temp_zip.name, 'r') as zipf:
-                            zipf.extractall(extract_dir)
-                        
-                        # Clean up temp zip
+                    # Extract the zip file, its entries all start with the folder's own name
+                    transfer.state = "Extracting"
+                    with zipfile.ZipFile(temp_zip.name, 'r') as zipf:
+                        for member in zipf.infolist():
+                            inner = member.filename.split("/", 1)[1:]
+                            if inner and inner[0]:
+                                member.filename = inner[0]
+                                zipf.extract(member, final_path)
+                finally:
+                    # Clean up temp zip
+                    if os.path.exists(temp_zip.name):
                         os.unlink(temp_zip.name)
-                        
-                        final_path = os.path.join(extract_dir, original_name)
-                        client.send("SUCCESS".encode())
-                        messagebox.showinfo("Success", f"Folder extracted to:\n{final_path}")
-                    except Exception as e:
-                        if os.path.exists(temp_zip.name):
-                            os.unlink(temp_zip.name)
-                        client.send("FAIL".encode())
-                        messagebox.showerror("Error", f"Failed to extract folder: {str(e)}")
-                else:
-                    # Regular file handling
-                    save_path = filedialog.asksaveasfilename(
-                        defaultextension="",
-                        initialfile=filename,
-                        title="Save file as"
-                    )
-                    
-                    if not save_path:
-                        client.send("FAIL".encode())
-                        client.close()
-                        return
-                    
-                    with open(save_path, 'wb') as f:
-                        received = 0
-                        while received < filesize:
-                            data = client.recv(min(4096, filesize - received))
-                            if not data:
-                                break
-                            f.write(data)
-                            received += len(data)
-                    
-                    client.send("SUCCESS".encode())
-                    messagebox.showinfo("Success", f"File received and saved to:\n{save_path}")
                 
-                client.close()
+                message = f"Folder extracted to:\n{final_path}"
+            else:
+                # Regular file handling, target was reserved (or picked) when the item was accepted
+                save_path = target
+                with open(save_path, 'wb') as f:
+                    self.recv_stream(client, f, filesize, transfer, forward, extents)
+                message = f"File received and saved to:\n{save_path}"
+        except:
+            if forward:
+                forward.abort()
+            # Don't leave a truncated file or half extracted folder behind
+            if final_path:
+                shutil.rmtree(final_path, ignore_errors=True)
+            elif not is_folder and os.path.exists(target):
+                os.unlink(target)
+            raise
+        
+        transfer.state = "Done"
+        client.send(self._finish_relay(item_info, relay_state).encode())
+        self.set_status(f"✓ {'Folder' if is_folder else 'File'} received from {addr[0]}", "#4ade80")
+        self.post_ui(messagebox.showinfo, "Success", message)
+    
+    def start_share_indexer(self):
+        thread = threading.Thread(target=self._share_indexer_thread)
+        thread.daemon = True
+        thread.start()
+    
+    def _share_indexer_thread(self):
+        """Load the cached share index, then keep it up to date in the background"""
+        for name, share in self.load_shares().items():
+            self.shares.setdefault(name, share)
+        
+        while self.server_running:
+            changed = False
+            for share in list(self.shares.values()):
+                if any(share.rescan()):
+                    changed = True
+            if changed:
+                self.save_shares()
+            
+            self.rescan_event.wait(self.settings.get("share_rescan_interval", 300))
+            self.rescan_event.clear()
+    
+    def add_share(self, folder):
+        """Publish a folder, it gets indexed by the background indexer"""
+        name = os.path.basename(os.path.normpath(folder)) or folder
+        base, counter = name, 2
+        while name in self.shares:
+            name = f"{base} ({counter})"
+            counter += 1
+        self.shares[name] = ShareIndex(name, folder)
+        self.save_shares()
+        self.rescan_event.set()
+    
+    def remove_share(self, name):
+        self.shares.pop(name, None)
+        self.save_shares()
+    
+    def _serve_share_request(self, client, addr, request):
+        """Answer a peer browsing or fetching from our shared folders"""
+        try:
+            if self.settings.get("shares_trusted_only") and not self.is_trusted(addr[0]):
+                send_json(client, {"status": "ERROR", "error": "Shared folders are only available to trusted devices"})
+                return
+            
+            item_type = request["type"]
+            if item_type == "list_shares":
+                shares = [share.stats() for share in list(self.shares.values())]
+                send_json(client, {"status": "OK", "shares": shares})
+                return
             
+            share = self.shares.get(request.get("share"))
+            if share is None:
+                send_json(client, {"status": "ERROR", "error": "Unknown share"})
+                return
+            
+            if item_type == "list":
+                offset = max(0, int(request.get("offset", 0)))
+                limit = min(max(1, int(request.get("limit", SHARE_PAGE_SIZE))), SHARE_PAGE_SIZE)
+                total, files = share.search(request.get("query", ""), offset, limit)
+                send_json(client, {"status": "OK", "total": total, "files": files})
+            else:
+                self._serve_fetch(client, addr, share, request)
         except Exception as e:
+            print(f"Error serving share request from {addr[0]}: {e}")
+        finally:
+            client.close()
+    
+    def _serve_fetch(self, client, addr, share, request):
+        """Send an indexed file, or a byte range of it, to a peer"""
+        try:
+            # The hash we send must be of what's on disk now, not of the last scan
+            path, entry = share.refresh(request.get("path", ""))
+        except OSError:
+            path = None
+        if path is None or not os.path.isfile(path):
+            send_json(client, {"status": "ERROR", "error": "File not found"})
+            return
+        
+        size = os.path.getsize(path)
+        offset = max(0, int(request.get("offset") or 0))
+        if offset > size:
+            send_json(client, {"status": "ERROR", "error": "Offset past end of file"})
+            return
+        length = request.get("length")
+        length = size - offset if length is None else max(0, min(int(length), size - offset))
+        
+        send_json(client, {"status": "OK", "size": size, "offset": offset, "length": length, "hash": entry[2]})
+        
+        transfer = self.add_transfer(Transfer(os.path.basename(path), addr[0], "⬆", length))
+        transfer.state = "Sending"
+        try:
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                self.send_stream(client, f, length, transfer)
+            transfer.state = "Done"
+        except TransferCancelled:
+            transfer.state = "Cancelled"
+        except:
+            transfer.state = "Failed"
+            raise
+    
+    def share_request(self, peer_ip, request):
+        """Send a pull-mode request to a peer, returns (socket, response)"""
+        sock = self.connect_peer(peer_ip)
+        try:
+            send_json(sock, dict(request, version=PROTOCOL_VERSION))
+            response = recv_json(sock)
+        except:
+            sock.close()
+            raise
+        if response.get("status") != "OK":
+            sock.close()
+            raise RuntimeError(response.get("error", "Request failed"))
+        return sock, response
+    
+    def list_peer_shares(self, peer_ip):
+        sock, response = self.share_request(peer_ip, {"type": "list_shares"})
+        sock.close()
+        return response["shares"]
+    
+    def search_peer_share(self, peer_ip, share, query="", offset=0, limit=SHARE_PAGE_SIZE):
+        """Returns (total matches, page of files) from a peer's share"""
+        sock, response = self.share_request(peer_ip, {
+            "type": "list",
+            "share": share,
+            "query": query,
+            "offset": offset,
+            "limit": limit
+        })
+        sock.close()
+        return response["total"], response["files"]
+    
+    def _fetch_thread(self, peer_ip, share, path, save_path, transfer):
+        """Download a whole file from a peer's share"""
+        sock = None
+        try:
+            transfer.state = "Connecting"
+            sock, response = self.share_request(peer_ip, {"type": "fetch", "share": share, "path": path})
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            sock.settimeout(None)
+            
+            transfer.total = response["length"]
+            transfer.state = "Receiving"
             try:
-                client.send("FAIL".encode())
+                with open(save_path, 'wb') as f:
+                    writer = HashingWriter(f)
+                    self.recv_stream(sock, writer, response["length"], transfer)
             except:
-                pass
-            messagebox.showerror("Error", f"Failed to receive: {str(e)}")
-            client.close()
+                if os.path.exists(save_path):
+                    os.unlink(save_path)
+                raise
+            
+            if response.get("hash") and writer.hexdigest() != response["hash"]:
+                # Changed while it was being read or since it was indexed, the copy can't be trusted
+                os.unlink(save_path)
+                transfer.state = "Failed"
+                self.set_status(f"✗ {os.path.basename(save_path)} changed on {peer_ip} while downloading, try again", "#ef4444")
+                return
+            
+            transfer.state = "Done"
+            self.set_status(f"✓ Downloaded {os.path.basename(save_path)}", "#4ade80")
+            
+        except TransferCancelled:
+            transfer.state = "Cancelled"
+            self.set_status("Download cancelled", "#888888")
+            
+        except Exception as e:
+            transfer.state = "Failed"
+            self.set_status("✗ Download failed", "#ef4444")
+            self.post_ui(messagebox.showerror, "Error", f"Failed to download {path}: {str(e)}")
+            
+        finally:
+            if sock:
+                sock.close()
 
 if __name__ == "__main__":
     root = tk.Tk()